@@ -0,0 +1,166 @@
+"""
+Batch queries over the spells, off Telegram: one query per line, in the /spellsearch syntax (see Parser)
+or as JSON filters ({"classes": "wizard", "level": "3"}, {"desc_search": "fire"}). The results are written
+as JSON lines in the input order, a summary goes to stderr.
+
+    python batch.py queries.txt > results.jsonl
+    cat queries.txt | python batch.py --processes 8 --fields name,level
+
+The queries run on a process pool. Every process maps the corpus snapshot (see snapshot.py), so they share one
+copy of it. Input is read and results are written as they go, at most WINDOW chunks are in flight.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from common import createLogger
+from dnd_spells import CacheCarier, CantParse, DBCarier, Parser, Spells
+from snapshot import SnapshotCarier
+
+logger = createLogger(__name__)
+
+CHUNK_SIZE = 64
+WINDOW = 4          # chunks in flight per process
+SAMPLE_SIZE = 10000     # latencies kept for the percentiles
+STORES = {'json': CacheCarier, 'snapshot': SnapshotCarier, 'db': DBCarier}
+
+_spells = None
+_fields = None
+
+
+def use_cache(path):
+    """ Points the stores at another JSON cache (e.g. a homebrew pack), the snapshot and database sit next to it """
+    CacheCarier.cache_path = path
+    SnapshotCarier.snapshot_path = f'{path}.snap'
+    DBCarier.db_path = f'{path}.db'
+
+
+def _init(store, fields, cache_path=None):
+    """ Pool process initializer """
+    global _spells, _fields
+    if cache_path:
+        use_cache(cache_path)
+    _spells = Spells(cache_carier=STORES[store]())
+    _fields = fields
+
+
+def parse(text):
+    """ A query line: JSON filters or a Parser query """
+    if text.startswith('{'):
+        filters = json.loads(text)
+        if not isinstance(filters, dict):
+            raise CantParse('JSON filters must be an object')
+        return filters
+    return Parser()(text)
+
+
+def run_query(spells, text, fields=('index',)) -> dict:
+    started = time.perf_counter()
+    try:
+        ids = spells.select(parse(text))
+        if len(fields) == 1:
+            found = [getattr(spells[x], fields[0]) for x in ids]
+        else:
+            found = [{f: getattr(spells[x], f) for f in fields} for x in ids]
+    except Exception as e:
+        # a wrong query (an unknown field, a too deep one...) fails its own line only, not the chunk
+        return {'query': text, 'error': f'{type(e).__name__}: {e}', 'seconds': time.perf_counter() - started}
+    return {'query': text, 'count': len(ids), 'spells': found, 'seconds': time.perf_counter() - started}
+
+
+def _run_chunk(chunk) -> list:
+    return [{'line': number, **run_query(_spells, text, _fields)} for number, text in chunk]
+
+
+def _chunks(lines, size):
+    chunk = []
+    for number, line in enumerate(lines, 1):
+        text = line.strip()
+        if text:
+            chunk.append((number, text))
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def run(lines, processes=None, store='snapshot', fields=('index',), cache_path=None, chunk_size=CHUNK_SIZE):
+    """
+    Runs the query lines on a process pool, yields {'line', 'query', 'count', 'spells', 'seconds'}
+    (or 'error' instead of 'count' and 'spells') in the input order
+    """
+    processes = processes or os.cpu_count()
+    if store == 'snapshot':
+        # built once here rather than by every process at once
+        if cache_path:
+            use_cache(cache_path)
+        SnapshotCarier.get_spells()
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(processes, mp_context=context, initializer=_init,
+                             initargs=(store, tuple(fields), cache_path)) as executor:
+        pending = deque()
+        for chunk in _chunks(lines, chunk_size):
+            pending.append(executor.submit(_run_chunk, chunk))
+            if len(pending) >= processes * WINDOW:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+class Summary:
+    """ Counts and latency percentiles of a reservoir sample of the queries """
+    def __init__(self):
+        self.count = self.errors = self.found = 0
+        self.sample = []
+        self.started = time.perf_counter()
+        self.__random = random.Random(0)
+
+    def add(self, result):
+        self.count += 1
+        self.errors += 'error' in result
+        self.found += result.get('count', 0)
+        if len(self.sample) < SAMPLE_SIZE:
+            self.sample.append(result['seconds'])
+        elif (i := self.__random.randrange(self.count)) < SAMPLE_SIZE:
+            self.sample[i] = result['seconds']
+
+    def __str__(self):
+        took = time.perf_counter() - self.started
+        sample = sorted(self.sample) or [0.0]
+        percentile = lambda p: sample[min(len(sample) - 1, int(len(sample) * p))] * 1000
+        return (f'{self.count} queries ({self.errors} errors, {self.found} spells found) in {took:.2f} s: '
+                f'{self.count / took if took else 0:.0f} queries/s, '
+                f'latency p50 {percentile(0.5):.2f} ms, p99 {percentile(0.99):.2f} ms, max {sample[-1] * 1000:.2f} ms')
+
+
+def main(argv=None):
+    args = argparse.ArgumentParser(description='Runs spell queries in bulk, prints JSON lines')
+    args.add_argument('input', nargs='?', default='-', help='query file, - for stdin')
+    args.add_argument('--processes', type=int, default=os.cpu_count())
+    args.add_argument('--store', choices=sorted(STORES), default='snapshot')
+    args.add_argument('--cache', help='JSON spells cache to query instead of the default one')
+    args.add_argument('--fields', default='index', help='spell fields in the results, comma separated')
+    args.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = args.parse_args(argv)
+
+    summary = Summary()
+    lines = sys.stdin if args.input == '-' else open(args.input)
+    try:
+        for result in run(lines, args.processes, args.store, args.fields.split(','), args.cache, args.chunk_size):
+            summary.add(result)
+            sys.stdout.write(json.dumps(result) + '\n')
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    print(summary, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Local stand-in for the D&D 5e API serving spells from .cached-spells, with injected latency and failures.
+
+    python benchmarks/fake_api.py [--port 8000] [--latency 0.05] [--fail-rate 0.1]
+
+Then point APICarier at it:
+
+    APICarier.API_SPELLS_URL = 'http://127.0.0.1:8000/api/spells/'
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dnd_spells import CacheCarier
+
+PREFIX = '/api/spells/'
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests_count += 1
+        time.sleep(server.latency * random.uniform(0.5, 1.5))
+        if random.random() < server.fail_rate:
+            return self.reply(503, {'error': 'Injected failure'})
+
+        if not self.path.startswith(PREFIX):
+            return self.reply(404, {'error': 'Not found'})
+        index = self.path[len(PREFIX):].strip('/')
+        if index and index not in server.spells:
+            return self.reply(404, {'error': 'Not found'})
+        body, etag = server.spells[index] if index else server.index
+        if etag == self.headers.get('If-None-Match'):
+            return self.reply(304, None, etag)
+        self.reply(200, body, etag)
+
+    def reply(self, status, body, etag=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeAPI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, fail_rate=0.0, spells=None):
+        super().__init__(('127.0.0.1', port), FakeAPIHandler)
+        self.spells = {}
+        self.index = None
+        self.update(spells if spells is not None else CacheCarier.get_spells()['spells'])
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.requests_count = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def etag(body):
+        return '"' + hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest() + '"'
+
+    def update(self, spells: list):
+        """ Replaces the served spells, ETags change only for the changed ones """
+        self.spells = {x['index']: (x, self.etag(x)) for x in spells}
+        index = {'count': len(spells), 'results': [
+            {'index': x['index'], 'name': x['name'], 'url': x['url']} for x in spells]}
+        self.index = (index, self.etag(index))
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}{PREFIX}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--port', type=int, default=8000)
+    arg_parser.add_argument('--latency', type=float, default=0.05)
+    arg_parser.add_argument('--fail-rate', type=float, default=0.1)
+    args = arg_parser.parse_args()
+    api = FakeAPI(args.port, args.latency, args.fail_rate)
+    print(f'Serving {len(api.spells)} spells at {api.url}')
+    api.serve_forever()
@@ -0,0 +1,38 @@
+"""
+Cold cache rebuild against the local stand-in API.
+
+    python benchmarks/fetch.py [--latency 0.05] [--fail-rate 0.1] [--concurrency 8]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dnd_spells import APICarier
+from fake_api import FakeAPI
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--latency', type=float, default=0.05)
+    arg_parser.add_argument('--fail-rate', type=float, default=0.1)
+    arg_parser.add_argument('--concurrency', type=int, default=APICarier.CONCURRENCY)
+    args = arg_parser.parse_args()
+
+    api = FakeAPI(latency=args.latency, fail_rate=args.fail_rate).start()
+    APICarier.API_SPELLS_URL = api.url
+    APICarier.CONCURRENCY = args.concurrency
+    APICarier.BACKOFF = 0.05
+
+    started = time.perf_counter()
+    spells = APICarier.get_spells()['spells']
+    took = time.perf_counter() - started
+    print(f'{len(spells)} spells in {took:.2f}s, {api.requests_count} requests '
+          f'({api.requests_count - len(spells) - 1} retries), concurrency {args.concurrency}')
+    api.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""
+Full text index sizing: build time, memory size and query latency.
+
+    python benchmarks/fulltext.py [replicas]
+"""
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dnd_spells import CacheCarier, Spells
+from fulltext import FullTextIndex
+
+QUERIES = ['fire', 'acid damage', '"sphere of fire"', 'teleport', 'heal hit points', 'fireba', 'xyzzy']
+
+
+def main(replicas=1):
+    spells = Spells(spells=CacheCarier.get_spells()['spells']).spells * replicas
+    index = FullTextIndex(spells)
+    print(f'{len(spells)} spells')
+    for key, value in index.stats().items():
+        print(f'{key}: {value}')
+
+    for q in QUERIES:
+        timings = []
+        for _ in range(50):
+            started = time.perf_counter()
+            found = index.search(q)
+            timings.append(time.perf_counter() - started)
+        print(f'{q!r}: {len(found)} found, median {statistics.median(timings) * 1000:.3f} ms, '
+              f'max {max(timings) * 1000:.3f} ms')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1)
@@ -0,0 +1,62 @@
+"""
+Query throughput with logging off, at the production level (INFO) and at DEBUG.
+Every level runs in a fresh process with stderr sent to /dev/null.
+
+    python benchmarks/logging_overhead.py [replicas]
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LEVELS = [('off', 'CRITICAL'), ('production', 'INFO'), ('debug', 'DEBUG')]
+FILTERS = [{'classes': 'wizard', 'level': '3'}, {'ritual': 'true', 'school': 'divination'}]
+QUERIES = ['level<=3 & (school=evocation | school=necromancy)', 'class=cleric & level in 1..3']
+DESC_QUERIES = ['fire', 'acid damage', 'heal hit points']
+NAMES = ['acid', 'fireball', 'magic misile']
+DURATION = 2.0
+
+
+def child(replicas):
+    from dnd_spells import CacheCarier, Parser, Spells
+
+    class UncachedSpells(Spells):
+        RESULT_CACHE_SIZE = 0
+
+    spells = UncachedSpells(spells=Spells(spells=CacheCarier.get_spells()['spells']).spells * replicas)
+    parser = Parser()
+    calls = [lambda f=f: spells.get_spells_by(f) for f in FILTERS] + \
+        [lambda q=q: spells.get_spells_by(parser(q)) for q in QUERIES] + \
+        [lambda q=q: spells.get_spells_by({'desc_search': q}) for q in DESC_QUERIES] + \
+        [lambda n=n: spells.get_spells_by_name(n) for n in NAMES]
+    for call in calls:
+        call()
+
+    ops = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < DURATION:
+        for call in calls:
+            call()
+        ops += len(calls)
+    return ops / (time.perf_counter() - started)
+
+
+def main(replicas=1):
+    print(f'{replicas} x .cached-spells')
+    res = {}
+    for name, level in LEVELS:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', str(replicas)],
+                             env={**os.environ, 'LOG_LEVEL': level}, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, check=True, universal_newlines=True).stdout
+        res[name] = json.loads(out)
+        print(f'logging {name:<10} ({level}): {res[name]:8.0f} queries/s ({res[name] / res["off"]:.2f} of off)')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        print(json.dumps(child(int(sys.argv[2]))))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 1)
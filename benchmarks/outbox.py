@@ -0,0 +1,62 @@
+"""
+Outbox delivery against a fake Bot recording the time of every call.
+Checks per chat ordering and rate limits, reports throughput, queue depth and latency.
+
+    python benchmarks/outbox.py [chats] [messages per chat]
+"""
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from outbox import Outbox
+
+
+class FakeBot:
+    def __init__(self, latency=0.02):
+        self.latency = latency
+        self.calls = defaultdict(list)   # chat_id -> [(time, text)]
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        with self.lock:
+            self.calls[chat_id].append((time.monotonic(), text))
+        return text
+
+
+def main(chats=50, messages=5):
+    bot = FakeBot()
+    outbox = Outbox(workers=8).start()
+
+    started = time.monotonic()
+    for i in range(messages):
+        for chat_id in range(chats):
+            outbox.submit(chat_id, bot.send_message, chat_id, f'{chat_id}:{i}')
+    enqueued = time.monotonic() - started
+    max_depth = 0
+    while (depth := outbox.queue_depth()):
+        max_depth = max(max_depth, depth)
+        time.sleep(0.05)
+    outbox.stop()
+    took = time.monotonic() - started
+
+    all_times = sorted(t for calls in bot.calls.values() for t, _ in calls)
+    busiest = max(sum(1 for t in all_times if s <= t < s + 1) for s in all_times)
+    for chat_id, calls in bot.calls.items():
+        assert [x for _, x in calls] == [f'{chat_id}:{i}' for i in range(messages)], f'chat {chat_id} out of order'
+        gaps = [b - a for (a, _), (b, _) in zip(calls[outbox.chat_burst:], calls[outbox.chat_burst + 1:])]
+        assert all(x >= 0.9 / outbox.chat_rate for x in gaps), f'chat {chat_id} rate exceeded'
+    assert busiest <= outbox.global_bucket.capacity + outbox.global_bucket.rate, 'global rate exceeded'
+
+    print(f'{chats * messages} messages to {chats} chats: enqueued in {enqueued * 1000:.1f} ms, '
+          f'delivered in {took:.2f}s, at most {busiest} per second, max queue depth {max_depth}')
+    print(outbox.stats())
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:3]])
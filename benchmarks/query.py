@@ -0,0 +1,48 @@
+"""
+Compiled query plans against the Spell.is_fit loop.
+
+    python benchmarks/query.py [replicas]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dnd_spells import CacheCarier, Parser, Spells
+
+# equality only queries, so the is_fit loop can answer them too
+QUERIES = [
+    ('class=wizard', {'classes': 'wizard'}),
+    ('class=wizard & level=3', {'classes': 'wizard', 'level': '3'}),
+    ('ritual=true & school=divination', {'ritual': 'true', 'school': 'divination'}),
+    ('level=2 & concentration=false & components has M', {'level': '2', 'concentration': 'false', 'components': 'M'}),
+]
+ROUNDS = 20
+
+
+def timeit(f) -> float:
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        f()
+    return (time.perf_counter() - started) / ROUNDS
+
+
+def main(replicas=10):
+    spells = Spells(spells=Spells(spells=CacheCarier.get_spells()['spells']).spells * replicas)
+    index = spells.index
+    parser = Parser()
+    print(f'{len(spells)} spells')
+    for text, filters in QUERIES:
+        loop = timeit(lambda: [x for x in spells.spells if x.is_fit(filters)])
+        parse = timeit(lambda: (Parser.compile.cache_clear(), parser(text)))
+        cached = timeit(lambda: parser(text))
+        query = parser(text)
+        plan = timeit(lambda: query.execute(index))
+        assert len(query.execute(index)) == len([x for x in spells.spells if x.is_fit(filters)])
+        print(f'{text!r}: is_fit loop {loop * 1000:.3f} ms, plan {plan * 1000:.3f} ms ({loop / plan:.0f}x), '
+              f'parse {parse * 1000:.3f} ms, cached parse {cached * 1000:.4f} ms')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,91 @@
+"""
+SettingsStore under simulated load: many users with skewed activity, mostly reads (/spellsearch reads the class)
+and some writes (/class). Write-behind batching against a flush after every write, reports throughput,
+disk reads and the flush cost.
+
+    python benchmarks/settings_store.py [users] [operations]
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from settings_store import USER, SettingsStore
+
+CLASSES = ['Bard', 'Cleric', 'Druid', 'Paladin', 'Ranger', 'Sorcerer', 'Warlock', 'Wizard']
+WRITE_SHARE = 0.05
+THREADS = 4
+
+
+def load(users, operations, seed=1) -> list:
+    """ (user id, class or None for a read), a few users make most of the requests """
+    rnd = random.Random(seed)
+    res = []
+    for _ in range(operations):
+        user_id = min(int(rnd.paretovariate(1.2)) - 1, users - 1) if rnd.random() < 0.8 else rnd.randrange(users)
+        res.append((user_id, rnd.choice(CLASSES) if rnd.random() < WRITE_SHARE else None))
+    return res
+
+
+def run(store, operations, write_through=False) -> dict:
+    latencies = []
+
+    def client(part):
+        for user_id, user_class in part:
+            started = time.perf_counter()
+            if user_class is None:
+                store.get(USER, user_id).get('class')
+            else:
+                store.update(USER, user_id, {'class': user_class})
+                if write_through:
+                    store.flush()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(operations[i::THREADS],)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    took = time.perf_counter() - started
+    store.stop()
+    latencies.sort()
+    return {'ops_per_s': len(operations) / took, 'p50_us': latencies[len(latencies) // 2] * 1e6,
+            'p99_us': latencies[int(len(latencies) * 0.99)] * 1e6, **store.stats()}
+
+
+def main(users=50000, count=200000):
+    operations = load(users, count)
+    writes = sum(1 for _, x in operations if x is not None)
+    print(f'{users} users, {count} operations ({writes} writes), {THREADS} threads')
+    with tempfile.TemporaryDirectory() as tmp:
+        # the users known from before: every one of them has settings on disk
+        seeded = SettingsStore(os.path.join(tmp, 'seed.db'), flush_size=10 ** 9)
+        for user_id in range(users):
+            seeded.update(USER, user_id, {'class': CLASSES[user_id % len(CLASSES)]})
+        started = time.perf_counter()
+        seeded.flush()
+        print(f'initial flush of {users} users: {(time.perf_counter() - started) * 1000:.0f} ms')
+
+        for name, write_through in (('write-behind', False), ('flush per write', True)):
+            path = os.path.join(tmp, f'{name}.db')
+            with open(os.path.join(tmp, 'seed.db'), 'rb') as src, open(path, 'wb') as dst:
+                dst.write(src.read())
+            store = SettingsStore(path).start()
+            res = run(store, operations, write_through)
+            flushes = max(1, res['flushes'])
+            print(f"{name:<16} {res['ops_per_s']:9.0f} ops/s, p50 {res['p50_us']:6.1f} us, p99 {res['p99_us']:8.1f} us, "
+                  f"disk reads {res['reads']}")
+            print(f"{'':<16} {res['flushes']} flushes of {res['flushed'] / flushes:.1f} rows, "
+                  f"{res['flush_seconds'] * 1000 / flushes:.2f} ms per flush, "
+                  f"{res['flush_seconds'] * 1e6 / max(1, res['flushed']):.1f} us per row, "
+                  f"{res['flush_seconds'] * 1000:.0f} ms in total")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 200000)
@@ -0,0 +1,68 @@
+"""
+Per spell memory and filter throughput: the former __dict__ based Spell against the fixed schema one.
+
+    python benchmarks/spell_memory.py [replicas]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import deep_sizeof
+from dnd_spells import CacheCarier, Normalizer, Spell, Spells
+
+norm = Normalizer()
+FILTERS = [{'classes': 'wizard'}, {'level': '2', 'classes': 'wizard'}, {'ritual': 'true'},
+           {'school': 'evocation', 'concentration': 'false'}]
+
+
+class DictSpell:
+    """ Spell as it used to be: an open __dict__ normalized on every is_fit call """
+    def __init__(self, **fields):
+        for f in fields: setattr(self, f, fields[f])
+
+    def is_fit(self, filter: dict):
+        for f_key, f_val in filter.items():
+            obj_val = norm(getattr(self, f_key))
+            if isinstance(obj_val, list):
+                if norm(f_val) not in obj_val:
+                    return False
+            else:
+                if norm(f_val) != obj_val:
+                    return False
+        return True
+
+
+def load(replicas, spell_cls):
+    with open(CacheCarier.cache_path) as f:
+        raw = f.read()
+    spells = []
+    for _ in range(replicas):
+        for x in json.loads(raw)['spells']:
+            spell = Spells.create_spell(x)
+            if spell_cls is not Spell:
+                # json round trip, so the old representation does not share interned strings
+                spell = spell_cls(**json.loads(json.dumps(spell.to_json())))
+            spells.append(spell)
+    return spells
+
+
+def filter_rate(spells):
+    started = time.perf_counter()
+    for f in FILTERS:
+        [x for x in spells if x.is_fit(f)]
+    return len(spells) * len(FILTERS) / (time.perf_counter() - started)
+
+
+def main(replicas=100):
+    for spell_cls in (DictSpell, Spell):
+        spells = load(replicas, spell_cls)
+        per_spell = deep_sizeof(spells) / len(spells)
+        print(f'{spell_cls.__name__}: {len(spells)} spells, {per_spell:.0f} bytes per spell, '
+              f'is_fit {filter_rate(spells):.0f} spells/s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -0,0 +1,67 @@
+"""
+Cold start of a worker: JSON cache against the mmapped snapshot. Every measurement runs in a fresh process.
+
+    python benchmarks/startup.py [replicas]
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def rss_kb() -> int:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def child(mode):
+    import logging
+    logging.disable(logging.INFO)
+    from dnd_spells import CacheCarier, Spells
+    from snapshot import SnapshotCarier
+
+    rss_before = rss_kb()
+    started = time.perf_counter()
+    spells = Spells(cache_carier=SnapshotCarier() if mode == 'snapshot' else CacheCarier())
+    loaded = time.perf_counter() - started
+    spells.get_spells_by({'classes': 'wizard', 'level': '3'})
+    first_query = time.perf_counter() - started
+    print(json.dumps({'mode': mode, 'spells': len(spells), 'load_s': loaded, 'first_query_s': first_query,
+                      'rss_kb': rss_kb() - rss_before}))
+
+
+def main(replicas=1):
+    from dnd_spells import CacheCarier
+    from snapshot import build
+
+    with open(os.path.join(ROOT, CacheCarier.cache_path)) as f:
+        spells = json.load(f)['spells']
+    replicated = []
+    for i in range(replicas):
+        for spell in spells:
+            replicated.append({**spell, 'index': f"{spell['index']}-{i}", 'name': f"{spell['name']} {i}"})
+
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, '.cached-spells'), 'w') as f:
+            json.dump({'spells': replicated}, f)
+        build({'spells': replicated}, os.path.join(workdir, '.cached-spells.snap'))
+        for mode in ('json', 'snapshot'):
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode],
+                                 cwd=workdir, capture_output=True, text=True, check=True).stdout
+            print(out.strip())
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 1)
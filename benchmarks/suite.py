@@ -0,0 +1,247 @@
+"""
+Benchmark suite of the spell engine hot paths over synthetic corpora of 1x, 10x, 100x and 1000x .cached-spells.
+Bigger corpora are made of mutated copies of the real spells. Every scale runs in a fresh process, so the peak
+memory is per scale. Runs offline and needs no Telegram token, only .cached-spells in the working directory.
+
+    python benchmarks/suite.py [--scales 1,10,100,1000] [--output benchmark-report.json]
+                               [--baseline benchmarks/baseline.json] [--save-baseline] [--tolerance 0.25]
+
+Latencies are compared to the baseline, a p50 or peak memory regression over the tolerance fails the run with
+a non-zero exit status, so does a missing baseline. Baselines are machine specific, none is committed: store one
+with --save-baseline on the machine running the checks. Note that 1000x takes a few GB of memory.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+
+SCALES = [1, 10, 100, 1000]
+BUDGET = 1.0      # seconds per benchmark, every input runs at least once
+MAX_OPS = 5000
+SAMPLE = 2000     # spells for create_spell and detailed_spell
+MIN_REGRESSION_MS = 0.02
+
+SUFFIXES = ['Lesser', 'Greater', 'Mass', 'Swift', 'Dark', 'Radiant', 'Arcane', 'Primal', 'Elder', 'Hidden']
+FILTERS = [
+    {'classes': 'wizard'},
+    {'classes': 'wizard', 'level': '3'},
+    {'ritual': 'true', 'school': 'divination'},
+    {'level': '2', 'concentration': 'false', 'components': 'M'},
+    {'damage_type': 'fire'},
+]
+QUERIES = [
+    'level<=3 & (school=evocation | school=necromancy) & !concentration=true',
+    'class=cleric & level in 1..3',
+    'components has M & ritual=true',
+    'level=0 | damage_type=acid',
+]
+DESC_QUERIES = ['fire', 'acid damage', '"sphere of fire"', 'teleport', 'heal hit points']
+NAME_HITS = ['Acid Arrow', 'fireball', 'cure wounds', 'acid', 'wall of']
+NAME_MISSES = ['fyreball', 'magic misile', 'xyzzy plugh', 'qwertyuiop']
+
+
+def mutate(spell: dict, replica: int, rnd: random.Random, pools: dict) -> dict:
+    """ A new spell made of a real one, the replica 0 is the spell itself """
+    if not replica:
+        return spell
+    desc = list(spell['desc'])
+    rnd.shuffle(desc)
+    desc.append(' '.join(rnd.choice(pools['words']) for _ in range(8)) + '.')
+    return {
+        **spell,
+        'name': f"{spell['name']} {rnd.choice(SUFFIXES)} {replica}",
+        'index': f"{spell['index']}-{replica}",
+        'url': f"{spell['url']}-{replica}",
+        'level': rnd.randint(0, 9),
+        'school': rnd.choice(pools['schools']),
+        'classes': rnd.sample(pools['classes'], rnd.randint(1, 4)),
+        'ritual': rnd.random() < 0.1,
+        'concentration': rnd.random() < 0.4,
+        'desc': desc,
+    }
+
+
+def generate(source: str, scale: int, path: str, seed=0):
+    """ Writes the corpus spell by spell, so the generator itself does not hold it in memory """
+    with open(source) as f:
+        spells = json.load(f)['spells']
+    pools = {
+        'schools': list({x['school']['name']: x['school'] for x in spells}.values()),
+        'classes': list({c['name']: c for x in spells for c in x['classes']}.values()),
+        'words': sorted({w for x in spells for line in x['desc'] for w in line.split() if w.isalpha()}),
+    }
+    rnd = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write('{"spells": [')
+        for replica in range(scale):
+            for i, spell in enumerate(spells):
+                if replica or i:
+                    f.write(', ')
+                f.write(json.dumps(mutate(spell, replica, rnd, pools)))
+        f.write('], "versions": {}, "index_version": null}')
+
+
+def measure(func, inputs, setup=None, budget=BUDGET, max_ops=MAX_OPS) -> dict:
+    """ Calls func over the inputs round robin until the time budget is spent, setup is not timed """
+    timings = []
+    started = time.perf_counter()
+    while True:
+        for x in inputs:
+            if setup:
+                setup()
+            t = time.perf_counter()
+            func(x)
+            timings.append(time.perf_counter() - t)
+        if time.perf_counter() - started >= budget or len(timings) >= max_ops:
+            break
+    timings.sort()
+    pick = lambda p: timings[min(len(timings) - 1, int(p * len(timings)))] * 1000
+    return {
+        'ops': len(timings),
+        'p50_ms': pick(0.5),
+        'p90_ms': pick(0.9),
+        'p99_ms': pick(0.99),
+        'max_ms': timings[-1] * 1000,
+        'ops_per_s': len(timings) / sum(timings) if sum(timings) else None,
+    }
+
+
+def once(func) -> dict:
+    return measure(lambda _: func(), [None], max_ops=1)
+
+
+def child(scale: int, source: str) -> dict:
+    logging.disable(logging.INFO)
+    from dnd_spells import CacheCarier, Parser, Spells
+
+    class UncachedSpells(Spells):
+        """ Every query reaches the indexes, not the results cache """
+        RESULT_CACHE_SIZE = 0
+
+    # bot.py needs a token at import time only
+    try:
+        import setup
+    except ImportError:
+        sys.modules['setup'] = types.SimpleNamespace(TOKEN=None)
+    import bot
+
+    res = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        CacheCarier.cache_path = os.path.join(tmp, 'corpus.json')
+        generate(source, scale, CacheCarier.cache_path)
+        res['load_cache'] = measure(lambda _: CacheCarier.get_spells(), [None], max_ops=3)
+        raw = CacheCarier.get_spells()['spells']
+
+    step = max(1, len(raw) // SAMPLE)
+    copies = [dict(x) for x in raw[::step]]
+    res['create_spell'] = measure(Spells.create_spell, copies, max_ops=len(copies))
+    built = []
+    res['build_spells'] = once(lambda: built.append(UncachedSpells(spells=raw)))
+    spells = built.pop()
+    del raw, copies
+    res['build_fulltext'] = once(lambda: spells.fulltext)
+    res['build_names'] = once(lambda: spells.names)
+
+    parser = Parser()
+    res['parse'] = measure(parser, QUERIES, setup=Parser.compile.cache_clear)
+    res['parse_cached'] = measure(parser, QUERIES)
+    res['get_spells_by_filters'] = measure(spells.get_spells_by, FILTERS)
+    res['get_spells_by_query'] = measure(spells.get_spells_by, [parser(x) for x in QUERIES])
+    res['search_by_desc'] = measure(spells.search_by_desc, DESC_QUERIES)
+    res['get_spells_by_name_hit'] = measure(spells.get_spells_by_name, NAME_HITS)
+    res['get_spells_by_name_miss'] = measure(spells.get_spells_by_name, NAME_MISSES)
+    res['detailed_spell'] = measure(bot.detailed_spell, [spells[x] for x in range(0, len(spells), step)])
+    return {
+        'spells': len(spells),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'benchmarks': res,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for scale, res in report['scales'].items():
+        base = baseline.get('scales', {}).get(scale)
+        if not base:
+            continue
+        if res['peak_rss_kb'] > base['peak_rss_kb'] * (1 + tolerance):
+            regressions.append(f"{scale}x peak memory: {base['peak_rss_kb']} -> {res['peak_rss_kb']} KB")
+        for name, stats in res['benchmarks'].items():
+            old = base['benchmarks'].get(name)
+            if not old:
+                continue
+            if stats['p50_ms'] > old['p50_ms'] * (1 + tolerance) and \
+                    stats['p50_ms'] - old['p50_ms'] > MIN_REGRESSION_MS:
+                regressions.append(f"{scale}x {name} p50: {old['p50_ms']:.3f} -> {stats['p50_ms']:.3f} ms")
+    return regressions
+
+
+def print_scale(scale: str, res: dict):
+    print(f"{scale}x: {res['spells']} spells, peak memory {res['peak_rss_kb'] / 1024:.0f} MB")
+    for name, stats in res['benchmarks'].items():
+        print(f"    {name:<26} p50 {stats['p50_ms']:10.3f} ms  p99 {stats['p99_ms']:10.3f} ms  "
+              f"{stats['ops_per_s'] or 0:12.0f} ops/s  ({stats['ops']} ops)")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--scales', default=','.join(map(str, SCALES)))
+    ap.add_argument('--source', default='.cached-spells', help='the real corpus')
+    ap.add_argument('--output', default='benchmark-report.json')
+    ap.add_argument('--baseline', default=os.path.join(ROOT, 'baseline.json'))
+    ap.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    ap.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown, 0.25 is 25%%')
+    ap.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        print(json.dumps(child(args.child, os.path.abspath(args.source))))
+        return
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'scales': {},
+    }
+    for scale in args.scales.split(','):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', scale, '--source', args.source],
+                             stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        report['scales'][scale] = json.loads(out.strip().splitlines()[-1])
+        print_scale(scale, report['scales'][scale])
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Report: {args.output}')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved the baseline: {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f'\nREGRESSIONS against {args.baseline} (tolerance {args.tolerance:.0%}):')
+            for x in regressions:
+                print(f'    {x}')
+            sys.exit(1)
+        print(f'No regressions against {args.baseline}')
+    else:
+        print(f'\nNO BASELINE at {args.baseline}, run with --save-baseline to store one')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
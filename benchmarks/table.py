@@ -0,0 +1,63 @@
+"""
+SpellIndex (posting sets) against SpellTable (NumPy columns): build time, filters, compiled queries and sorting.
+
+    python benchmarks/table.py [replicas]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dnd_spells import CacheCarier, Parser, SpellIndex, Spells, SpellTable
+
+FILTERS = [
+    {'classes': 'wizard'},
+    {'classes': 'wizard', 'level': '3'},
+    {'ritual': 'true', 'school': 'divination'},
+    {'level': '2', 'concentration': 'false', 'components': 'M'},
+]
+QUERIES = [
+    'level<=3 & (school=evocation | school=necromancy) & !concentration=true',
+    'class=cleric & level in 1..3',
+    'components has M & ritual=true',
+]
+ROUNDS = 20
+
+
+def timeit(f) -> float:
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        f()
+    return (time.perf_counter() - started) / ROUNDS
+
+
+def main(replicas=100):
+    spells = Spells(spells=CacheCarier.get_spells()['spells']).spells * replicas
+    print(f'{len(spells)} spells')
+    started = time.perf_counter()
+    index = SpellIndex(spells)
+    index_build = time.perf_counter() - started
+    started = time.perf_counter()
+    table = SpellTable(spells)
+    print(f'build: index {index_build:.3f} s, table {time.perf_counter() - started:.3f} s')
+
+    for filters in FILTERS:
+        assert index.query(filters) == table.query(filters)
+        a, b = timeit(lambda: index.query(filters)), timeit(lambda: table.query(filters))
+        print(f'{filters}: index {a * 1000:.3f} ms, table {b * 1000:.3f} ms ({a / b:.1f}x)')
+    for text in QUERIES:
+        query = Parser()(text)
+        assert query.execute(index) == query.execute(table)
+        a, b = timeit(lambda: query.execute(index)), timeit(lambda: query.execute(table))
+        print(f'{text!r}: index {a * 1000:.3f} ms, table {b * 1000:.3f} ms ({a / b:.1f}x)')
+
+    ids = table.query({'classes': 'wizard'})
+    by_objects = timeit(lambda: sorted(ids, key=lambda x: (int(spells[x].level), spells[x].normed('name'))))
+    by_columns = timeit(lambda: table.sort(ids, 'level'))
+    print(f'sort {len(ids)} by level: Spell objects {by_objects * 1000:.3f} ms, columns {by_columns * 1000:.3f} ms')
+    print(f"schools count: {timeit(lambda: table.counts('school')) * 1000:.3f} ms")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -0,0 +1,132 @@
+"""
+Webhook server under load: keep-alive clients POST updates to a WebhookServer running the bot handlers
+against an offline Bot that records its calls. Reports sustained updates/s and response latency.
+
+    python benchmarks/webhook.py [updates] [clients] [updates.jsonl]
+
+updates.jsonl holds one recorded Telegram update per line, synthetic commands are sent without it.
+Runs offline and needs no Telegram token, only .cached-spells in the working directory.
+"""
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('LOG_LEVEL', 'WARNING')   # the handlers log every update at INFO
+# bot.py needs a token at import time only, the Bot here is offline
+try:
+    import setup
+except ImportError:
+    sys.modules['setup'] = types.SimpleNamespace(TOKEN=None)
+
+from telegram import Bot, User
+from telegram.ext import Dispatcher
+
+import bot
+from dnd_spells import CacheCarier
+from outbox import Outbox
+from settings_store import SettingsStore
+from webhook import WebhookServer
+
+COMMANDS = ['/spellnamed fireball', '/spellnamed acid', '/spellnamed magic misile', '/spellsearch level=2 & ritual=true',
+            '/spellsearch level<=3 & (school=evocation | school=necromancy)', '/spellsearch heal hit points',
+            '/class wizard', '/help']
+CHATS = 500
+PATH = '/bot'
+
+
+class OfflineBot(Bot):
+    """ Never calls the Bot API, counts the calls instead """
+    def __init__(self):
+        super().__init__(token='100:benchmark')
+        self._bot = User(0, 'Benchmark', True, username='benchmark_bot')
+        self.calls = 0
+        self.__lock = threading.Lock()
+
+    def __record(self):
+        with self.__lock:
+            self.calls += 1
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.__record()
+
+    def edit_message_text(self, text=None, **kwargs):
+        self.__record()
+
+
+def synthetic(count):
+    for update_id in range(count):
+        chat_id = random.randrange(1, CHATS + 1)
+        text = random.choice(COMMANDS)
+        command = text.split()[0]
+        yield {'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]}}
+
+
+async def client(port, bodies, latencies, statuses):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    for body in bodies:
+        started = time.perf_counter()
+        writer.write(f'POST {PATH} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n'
+                     f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+        status = int((await reader.readline()).split()[1])
+        while (await reader.readline()) not in (b'\r\n', b''):
+            pass
+        latencies.append(time.perf_counter() - started)
+        statuses[status] = statuses.get(status, 0) + 1
+    writer.close()
+
+
+async def run(updates, clients):
+    offline = OfflineBot()
+    dispatcher = Dispatcher(offline, None, workers=1, use_context=True)
+    bot.add_handlers(dispatcher)
+    server = await WebhookServer(dispatcher, port=0, path=PATH).start()
+
+    bodies = [json.dumps(update).encode() for update in updates]
+    latencies, statuses = [], {}
+    started = time.perf_counter()
+    await asyncio.gather(*(client(server.port, bodies[i::clients], latencies, statuses) for i in range(clients)))
+    took = time.perf_counter() - started
+    await server.stop()
+    bot.outbox.stop()
+
+    latencies.sort()
+    print(f'{len(bodies)} updates, {clients} clients: {len(bodies) / took:.0f} updates/s, '
+          f'p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms')
+    print(f'statuses {statuses}, server {server.stats()}, bot calls {offline.calls}')
+
+
+def main(count=5000, clients=50, path=None):
+    if path:
+        with open(path) as f:
+            updates = list(itertools.islice(itertools.cycle([json.loads(line) for line in f if line.strip()]), count))
+    else:
+        updates = list(synthetic(count))
+    # /class reads class_icons.json, it is in resources/ out of the image
+    if not os.path.exists('class_icons.json'):
+        CacheCarier.cache_path = os.path.abspath(CacheCarier.cache_path)
+        os.chdir(os.path.join(ROOT, 'resources'))
+    # sends are not the subject here, the outbox must not throttle them
+    bot.outbox = Outbox(workers=8, global_rate=1e6, global_burst=10 ** 6, chat_rate=1e6, chat_burst=10 ** 6).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        bot.user_settings = SettingsStore(os.path.join(tmp, 'settings.db')).start()
+        asyncio.run(run(updates, clients))
+        bot.user_settings.stop()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 50,
+         sys.argv[3] if len(sys.argv) > 3 else None)
@@ -1,55 +1,111 @@
-from telegram import Bot, Update, ParseMode, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import CallbackContext, CommandHandler, Filters, MessageHandler, Updater, CallbackQueryHandler
+from startup import phases
+import functools
 import random
-import time
 import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import dedent
 
-from setup import TOKEN
-from telegram import Bot, Update, ParseMode, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import CallbackContext, CommandHandler, Filters, MessageHandler, Updater, CallbackQueryHandler
+with phases.phase('import telegram'):
+    from telegram import Bot, Update, ParseMode, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, \
+        InputTextMessageContent
+    from telegram.ext import CallbackContext, ChosenInlineResultHandler, CommandHandler, Dispatcher, Filters, \
+        MessageHandler, Updater, CallbackQueryHandler, InlineQueryHandler
 # from database import save_to_mongo, DatabaseUnavaliable
 
-from common import createLogger
-from dnd_spells import Parser, Spells, Spell, Normalizer, CantParse
+from setup import TOKEN
+with phases.phase('import spells modules'):
+    from common import createLogger
+    import metrics
+    from dnd_spells import CacheCarier, DBCarier, Parser, Spells, Spell, Normalizer, CantParse
+    from hot_reload import NotReady, Refresher, SpellsReference
+    from name_index import NameIndex
+    from outbox import Outbox, split_message
+    from render_cache import KeyboardCache, RenderCache
+    from settings_store import LISTING, USER, SettingsStore
+    from snapshot import SnapshotCarier
 
 
 logger = createLogger(__name__)
-with open('class_icons.json', 'r') as class_icons_file:
-    class_icons = json.load(class_icons_file)
-spells = Spells()
+# json: the JSON cache loaded by every process, snapshot: mmapped file shared by the processes (see workers.py),
+# db: SQLite
+SPELL_STORES = {'json': CacheCarier, 'snapshot': SnapshotCarier, 'db': DBCarier}
+WORKERS = int(os.environ.get('WORKERS', 0))    # worker processes behind a supervisor, 0 to handle updates in-process
+SPELL_STORE = os.environ.get('SPELL_STORE', 'snapshot' if WORKERS else 'json')
+# seconds between checks of the JSON cache for a new corpus, rebuilt in background and swapped in (see hot_reload.py)
+REFRESH_INTERVAL = float(os.environ.get('REFRESH_INTERVAL', 60))
+# spell views (normalized name -> count) rank the inline completions, re-ranked at most every POPULARITY_REFRESH s
+spell_views = Counter()
+POPULARITY_REFRESH = 600
+popularity_refreshed = time.monotonic()
+
+# threads building the indexes and renders once the corpus is loaded at startup, 0 to build them on the first use
+WARM_UP_THREADS = int(os.environ.get('WARM_UP_THREADS', 2))
+
+def load_spells() -> Spells:
+    """ The corpus from the spell store, its completions ranked by the views so far """
+    with phases.phase('load spells'):
+        res = Spells(cache_carier=SPELL_STORES[SPELL_STORE]())
+        res.set_popularity(spell_views)
+    return res
+
+# loaded on the first use or by start_loading() in main
+spells = SpellsReference(load=load_spells)
 norm = Normalizer()
+MAX_SPELLS_ALIKE = 10
+COMPRESS_RENDERS = False
+spell_texts = RenderCache(compress=COMPRESS_RENDERS)
+spell_buttons = RenderCache()
+spell_keyboards = KeyboardCache(maxsize=256)
+spell_articles = RenderCache()
+INLINE_RESULTS = 20
+INLINE_CACHE_TIME = 300
+# user and chat settings (the class) and search listings kept on disk (see settings_store.py),
+# opened by main() or by the worker process, so importing the bot creates no files
+SETTINGS_DB = os.environ.get('SETTINGS_DB')
+user_settings = None
+PAGE_SIZE = 99
+# seconds a listing stays in the settings store, its next page buttons say 'outdated' afterwards
+LISTING_TTL = 7 * 24 * 3600
+LISTINGS_PURGE_INTERVAL = 3600
+listings_purged = time.monotonic()
+METRICS_PORT = 9108     # Prometheus metrics at http://127.0.0.1:9108/metrics, None to switch off
+SLOW_QUERY_SECONDS = None   # log spell queries slower than this, with their filters
+SLOW_QUERY_SAMPLE = 0.1
+# webhook mode (see webhook.py) when the public URL is set, long polling otherwise
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+handler_metrics = metrics.timed('bot_handler')
+# the rate limited sender threads (see outbox.py), started by main() or by the worker process like user_settings
+outbox = None
+
+MAX_MESSAGE_LENGTH = 4048
 
 def send_message(bot, chat_id, text: str, **kwargs):
-    MAX_MESSAGE_LENGTH = 4048
-
-    if len(text) <= MAX_MESSAGE_LENGTH:
-        return bot.send_message(chat_id, text, **kwargs)
-
-    parts = []
-    while len(text) > 0:
-        if len(text) > MAX_MESSAGE_LENGTH:
-            part = text[:MAX_MESSAGE_LENGTH]
-            first_lnbr = part.rfind('\n')
-            if first_lnbr != -1:
-                parts.append(part[:first_lnbr])
-                text = text[first_lnbr:]
-            else:
-                parts.append(part)
-                text = text[MAX_MESSAGE_LENGTH:]
-        else:
-            parts.append(text)
-            break
-    msg = None
-    for part in parts:
-        msg = bot.send_message(chat_id, part, **kwargs)
-        time.sleep(1)
-    return msg  # return only the last message
+    """
+    Queues the message to the outbox, a long one is split into parts.
+    Returns a Future of the last part's Message
+    """
+    future = None
+    for part in split_message(text, MAX_MESSAGE_LENGTH):
+        future = outbox.submit(chat_id, bot.send_message, chat_id, part, **kwargs)
+    return future
+
+def reply(update: Update, context: CallbackContext, text: str, **kwargs):
+    return send_message(context.bot, update.message.chat_id, text, **kwargs)
 
 def overall_logging(handler):
     def inner(*args, **kwargs):
         update = args[0]
-        if update and hasattr(update, 'message') and hasattr(update, 'effective_user'):
+        if logger.isEnabledFor(logging.INFO) and update and hasattr(update, 'message') \
+                and hasattr(update, 'effective_user'):
             log_info = {
                 'time': str(update.message.date),
                 'handler': handler.__name__,
@@ -86,11 +142,45 @@ def detailed_spell(spell: Spell):
                 msg += f'\n{field.replace("_", " ")}: {_val}'
     return msg
 
+def render_spell(spell: Spell):
+    """ detailed_spell rendered once per corpus version """
+    return spell_texts.get(spells.version, spell.index or spell.name, lambda: detailed_spell(spell))
+
+def spell_callback(spell: Spell):
+    """ Callback data of a spell button: s:<spell index>, the spell name for spells without index """
+    return f's:{spell.index}' if spell.index else spell.name
+
+def spell_button(spell: Spell):
+    return spell_buttons.get(spells.version, spell.index or spell.name,
+                             lambda: InlineKeyboardButton(spell.str_nice(), callback_data=spell_callback(spell)))
+
+def spell_article(spell: Spell):
+    """ Inline query result of a spell, built once per corpus version """
+    text = lambda: split_message(render_spell(spell), MAX_MESSAGE_LENGTH)[0]
+    return spell_articles.get(spells.version, spell.index or spell.name, lambda: InlineQueryResultArticle(
+        id=(spell.index or spell.name)[:64], title=spell.name, description=f'{spell.school}, level {spell.level}',
+        input_message_content=InputTextMessageContent(text(), parse_mode=ParseMode.MARKDOWN)))
+
+def spell_viewed(spell: Spell):
+    spell_views[spell.normed('name')] += 1
+
+def spells_keyboard(found_spells) -> list:
+    """ Inline keyboard rows for a result set, cached for the common result sets """
+    found_spells = list(found_spells)
+    return spell_keyboards.get_rows(spells.version, found_spells, lambda: [[spell_button(x)] for x in found_spells])
+
+@functools.lru_cache(maxsize=None)
+def class_icons() -> dict:
+    with open('class_icons.json', 'r') as class_icons_file:
+        return json.load(class_icons_file)
+
 def replay_for_class(user_class):
     user_class = norm(user_class)
-    return random.choice(class_icons.get(user_class, class_icons['default']))
+    icons = class_icons()
+    return random.choice(icons.get(user_class, icons['default']))
 
 @overall_logging
+@handler_metrics
 def help_msg(update: Update, context: CallbackContext):
     help_text = """
                 /class [class]
@@ -123,14 +213,29 @@ def help_msg(update: Update, context: CallbackContext):
                         • /spellsearch level=2 & ritual=true
                         Command with filters and boolean *AND* operator gets satisfying spells.
 
+                        • /spellsearch level<=3 & (school=evocation | school=necromancy) & !concentration=true
+                        Filters can be combined with *&* (and), *|* (or), *!* (not) and parentheses.
+
+                        • /spellsearch level in 1..3 & components has M
+                        Level ranges and list fields lookups.
+
+                        • /spellsearch damage\\_type=fire & damage@3 >= 20 sort damage@3 desc
+                        Mean damage with a 3rd level slot (damage@c5 for a 5th level character, min\\_damage, max\\_damage), strongest first.
+
                         • /spellsearch keyword or sentence
-                        Return all spells with the word or sentence in their descriptions.
+                        Return all spells with the words in their names or descriptions, best matches first.
+
+                        • /spellsearch "sphere of fire"
+                        Quoted words are searched as a phrase.
 
                     *Filters:*
 
                         • level _int_
                         • ritual _bool_
                         • concentration _bool_
+                        • school, damage\\_type, components, subclass, ...
+
+                @<bot name> <spell name start> - spell names as you type, in any chat
 
                 /settings - show user's settings
 
@@ -139,15 +244,17 @@ def help_msg(update: Update, context: CallbackContext):
     send_message(context.bot, update.message.chat_id, text=dedent(help_text), parse_mode=ParseMode.MARKDOWN)
 
 @overall_logging
+@handler_metrics
 def settings(update: Update, context: CallbackContext):
-    user_class = context.user_data.get("class")
+    user_class = user_settings.get(USER, update.effective_user.id).get('class')
     if user_class:
         msg = f'Class: {user_class} {replay_for_class(user_class)}'
     else:
         msg = 'No class specified'
-    update.message.reply_text(msg)
+    reply(update, context, msg)
 
 @overall_logging
+@handler_metrics
 def set_class(update: Update, context: CallbackContext):
     """
     /class [class]
@@ -159,15 +266,17 @@ def set_class(update: Update, context: CallbackContext):
         user_class = norm(context.args[0])
         if user_class not in norm(classes):
             _msg = '\n'.join([f'• {x}' for x in classes])
-            update.message.reply_text(f'Wrong class: {user_class}.\n\nAvaliable D&D classes: \n\n{_msg}')
+            reply(update, context, f'Wrong class: {user_class}.\n\nAvaliable D&D classes: \n\n{_msg}')
             return
-        context.user_data['class'] = user_class.capitalize()
-        update.message.reply_text(replay_for_class(user_class))
+        user_settings.update(USER, update.effective_user.id, {'class': user_class.capitalize()})
+        reply(update, context, replay_for_class(user_class))
     except (IndexError, ValueError):
-        context.user_data["class"] = None
-        update.message.reply_text('No class specified\nTo set a class: /class <your class>')
+        user_settings.update(USER, update.effective_user.id, {'class': None})
+        reply(update, context, 'No class specified\nTo set a class: /class <your class>')
 
 @overall_logging
+@handler_metrics
+@spells.pin
 def spell_by_name(update: Update, context: CallbackContext):
     """
     /spellnamed <name>
@@ -175,111 +284,257 @@ def spell_by_name(update: Update, context: CallbackContext):
     user_input = context.args
     if user_input:
         user_input = ' '.join([arg for arg in context.args])
-        if(found_spells := spells.get_spells_by_name(user_input)):
+        if(found_spells := spells.match_names(user_input)):
             if len(found_spells) == 1:
-                update.message.reply_text(detailed_spell(found_spells.spells[0]), parse_mode=ParseMode.MARKDOWN)
+                spell_viewed(found_spells[0][0])
+                reply(update, context, render_spell(found_spells[0][0]), parse_mode=ParseMode.MARKDOWN)
             else:
-                keyboard = []
-                for spell in found_spells:
-                    keyboard.append([InlineKeyboardButton(f'{spell.str_nice()}', callback_data=spell.name)])
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                update.message.reply_text('Founded spells:', reply_markup=reply_markup)
+                misspelled = found_spells[0][1] < NameIndex.FUZZY_SCORE
+                if misspelled:
+                    found_spells = found_spells[:MAX_SPELLS_ALIKE]
+                reply_markup = InlineKeyboardMarkup(spells_keyboard(spell for spell, _ in found_spells))
+                reply(update, context, 'Did you mean:' if misspelled else 'Founded spells:', reply_markup=reply_markup)
         else:
-            update.message.reply_text('Nothing found')
+            reply(update, context, 'Nothing found')
     else:
-        update.message.reply_text('Usage: /spellnamed <spell name>')
+        reply(update, context, 'Usage: /spellnamed <spell name>')
 
 @overall_logging
+@handler_metrics
+@spells.pin
 def spell_search(update: Update, context: CallbackContext):
     """
     /spellsearch [filter1=var1 & filter2 = var2]
     if no filters /spellsearch returns all spells for pointed class
     """
 
-    filters = {}
-    if (user_class := context.user_data.get("class")):
-        filters.update({'classes': user_class})
-    
-    p = Parser()
+    listing = {'query': ' '.join(context.args or []),
+               'class': user_settings.get(USER, update.effective_user.id).get('class', '')}
+    filters = search_filters(listing)
+    logger.debug('Looking for spells: %s', filters)
 
-    if (user_input := context.args):
-        user_input = ' '.join([x for x in user_input])
+    found_spells = spells.select(filters)
+    logger.debug('Founded spells: %d', len(found_spells))
+    if found_spells:
+        send_listing(context, update.message.chat_id, 'Found spells:', listing)
+    else:
+        reply(update, context, 'Nothing found')
+
+def search_filters(listing: dict):
+    """ Filters of a /spellsearch listing: {'query': the user input, 'class': the user class}, both may be empty """
+    filters = {}
+    if listing.get('class'):
+        filters.update({'classes': listing['class']})
+    if (user_input := listing.get('query')):
         try:
-            filters.update(p(user_input))
+            return Parser()(user_input).with_filters(filters)
         except CantParse:
             filters.update({'desc_search': user_input})
-            # update.message.reply_text('Wrong filter to search')
-            # return
-
-    logger.debug(f'Looking for spells: {filters}')
-
-    found_spells = spells.get_spells_by(filters)
-    logger.debug(f'Founded spells: {", ".join([x.name for x in found_spells])}')
-    if found_spells:
-        found_spells_to_inline = {f'{spell.str_nice()}': spell.name for spell in found_spells}
-        context.chat_data['chat_id'] = update.message.chat_id
-        send_message_with_inline(context, 'Found spells:', found_spells_to_inline)
-    else:
-        update.message.reply_text('Nothing found')
+    return filters
 
 @overall_logging
 def error(update: Update, context: CallbackContext):
     logger.warning(f'Update {update} caused error: {context.error}')
+    if isinstance(context.error, NotReady) and update and update.effective_chat:
+        send_message(context.bot, update.effective_chat.id, 'The spells are still loading, please try again later')
 
 @overall_logging
+@handler_metrics
 def unknown(update: Update, context: CallbackContext):
-    update.message.reply_text('What a spell is this? I do not know this type of magic!')
-
-# TODO: rewrite it
-def send_message_with_inline(context, msg, inline_buttons: dict, remains_msg='...'):
-    context.chat_data['remains'] = None
-    context.chat_data['remains_msg'] = None
-
-    if len(inline_buttons) <= 100:
-        send_options = inline_buttons
-        remain_options = None
-    else:
-        send_options = dict(list(inline_buttons.items())[:99])
-        remain_options = dict(list(inline_buttons.items())[99:])
-
-    keyboard = []
-    for name, data in send_options.items():
-        keyboard.append([InlineKeyboardButton(name, callback_data=data)])
-    if remain_options:
-        context.chat_data['remains'] = remain_options
-        context.chat_data['remains_msg'] = msg
-        keyboard.append([InlineKeyboardButton(remains_msg, callback_data='IN_PROGRESS')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    send_message(context.bot, context.chat_data['chat_id'], msg, reply_markup=reply_markup)
+    reply(update, context, 'What a spell is this? I do not know this type of magic!')
 
+def send_listing(context, chat_id, msg, listing, offset=0, more_msg='...'):
+    """
+    One page of the spells of a listing (see search_filters), starting from offset.
+    The next page button carries p:<query fingerprint>:<offset>. The listing is saved by its fingerprint in the
+    settings store, shared by the workers and kept over restarts, and any page is rebuilt from the query result
+    """
+    filters = search_filters(listing)
+    found = spells.select(filters)
+    end = len(found) if len(found) - offset <= PAGE_SIZE + 1 else offset + PAGE_SIZE
+    keyboard = list(spells_keyboard(spells[x] for x in found[offset:end]))
+    if end < len(found):
+        fingerprint = spells.fingerprint(filters)
+        if saved_listing(fingerprint) is None:
+            save_listing(fingerprint, listing)
+        keyboard.append([InlineKeyboardButton(more_msg, callback_data=f'p:{fingerprint}:{end}')])
+    send_message(context.bot, chat_id, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+
+def saved_listing(fingerprint):
+    """ The listing saved by send_listing, None if there is none or it is older than LISTING_TTL """
+    listing = user_settings.get(LISTING, fingerprint)
+    if not listing or time.time() - listing.get('saved', 0) > LISTING_TTL:
+        return None
+    return listing
+
+def save_listing(fingerprint, listing):
+    """ Saves the listing for LISTING_TTL seconds, the expired ones are removed every LISTINGS_PURGE_INTERVAL """
+    global listings_purged
+    user_settings.update(LISTING, fingerprint, {**listing, 'saved': int(time.time())})
+    if time.monotonic() - listings_purged >= LISTINGS_PURGE_INTERVAL:
+        listings_purged = time.monotonic()
+        user_settings.purge(LISTING, 'saved', time.time() - LISTING_TTL)
+    # written before the button is sent, the worker of another user may get the press
+    user_settings.flush()
+
+@handler_metrics
+@spells.pin
 def button(update: Update, context: CallbackContext):
+    """
+    Callback data:
+        s:<spell index> - the spell description
+        p:<query fingerprint>:<offset> - the next page of a listing
+        <spell name> - buttons sent before the callback data format change
+    """
     query = update.callback_query
     query.answer()
-    if query.data != 'IN_PROGRESS':
-        spell = spells.get_spells_by_name(query.data).spells[0]
-        query.edit_message_text(text=detailed_spell(spell), parse_mode=ParseMode.MARKDOWN)
+    chat_id = query.message.chat_id
+    kind, _, data = query.data.partition(':')
+    if kind == 'p':
+        fingerprint, _, offset = data.partition(':')
+        listing = saved_listing(fingerprint)
+        if listing is None or not offset.isdigit():
+            send_message(context.bot, chat_id, 'The list is outdated, please repeat the search')
+            return
+        send_listing(context, chat_id, 'Found spells:', listing, int(offset))
+        return
+    if kind == 's':
+        spell = spells.get_spell(data)
+    elif query.data == 'IN_PROGRESS':
+        spell = None
     else:
-        send_message_with_inline(context, context.chat_data['remains_msg'], context.chat_data['remains'])
-
+        spell = next(iter(spells.get_spells_by_name(query.data).spells), None)
+    if spell is None:
+        send_message(context.bot, chat_id, 'The list is outdated, please repeat the search')
+        return
+    spell_viewed(spell)
+    outbox.submit(chat_id, query.edit_message_text, text=render_spell(spell), parse_mode=ParseMode.MARKDOWN)
+
+@handler_metrics
+@spells.pin
+def inline_spells(update: Update, context: CallbackContext):
+    """ @bot <name start>: spells completing the name, the most viewed first """
+    global popularity_refreshed
+    if time.monotonic() - popularity_refreshed >= POPULARITY_REFRESH:
+        popularity_refreshed = time.monotonic()
+        spells.set_popularity(spell_views)
+    query = update.inline_query
+    found = spells.complete_names(query.query, INLINE_RESULTS)
+    query.answer([spell_article(x) for x in found], cache_time=INLINE_CACHE_TIME)
+
+@spells.pin
+def inline_chosen(update: Update, context: CallbackContext):
+    """ Counts the views of spells sent inline, needs inline feedback switched on with @BotFather """
+    if (spell := spells.get_spell(update.chosen_inline_result.result_id)) is not None:
+        spell_viewed(spell)
+
+def register_metrics():
+    # the gauges do not wait for the corpus loading
+    no_results = {'size': 0, 'hits': 0, 'misses': 0}
+    cache_stats = lambda: {'results': spells.cache_stats() if spells.ready else no_results,
+                           'texts': spell_texts.stats(), 'buttons': spell_buttons.stats(),
+                           'keyboards': spell_keyboards.stats(), 'articles': spell_articles.stats(),
+                           'settings': user_settings.stats()}
+    metrics.registry.gauge('spells_corpus_size', 'spells loaded', lambda: len(spells) if spells.ready else 0)
+    metrics.registry.gauge('spells_cache_hits', 'cache hits', lambda: {k: v['hits'] for k, v in cache_stats().items()},
+                           ('cache',))
+    metrics.registry.gauge('spells_cache_misses', 'cache misses',
+                           lambda: {k: v['misses'] for k, v in cache_stats().items()}, ('cache',))
+    metrics.registry.gauge('spells_cache_size', 'cached entries',
+                           lambda: {k: v['size'] for k, v in cache_stats().items()}, ('cache',))
+    metrics.registry.gauge('outbox_queue_depth', 'outbound calls waiting', outbox.queue_depth)
+    metrics.registry.gauge('outbox_calls', 'outbound calls done',
+                           lambda: {'sent': outbox.stats()['sent'], 'failed': outbox.stats()['failed']}, ('result',))
+    metrics.registry.log_slow(SLOW_QUERY_SECONDS, SLOW_QUERY_SAMPLE)
+    if METRICS_PORT is not None:
+        metrics.registry.serve(METRICS_PORT)
+
+def add_handlers(dispatcher):
+    dispatcher.add_handler(CommandHandler('start', help_msg))
+    dispatcher.add_handler(CommandHandler('class', set_class, pass_args=True))
+    dispatcher.add_handler(CommandHandler('spellnamed', spell_by_name, pass_args=True))
+    dispatcher.add_handler(CommandHandler('spellsearch', spell_search, pass_args=True))
+    dispatcher.add_handler(CommandHandler('settings', settings))
+    dispatcher.add_handler(CommandHandler('help', help_msg))
+    dispatcher.add_handler(CallbackQueryHandler(button))
+    dispatcher.add_handler(InlineQueryHandler(inline_spells))
+    dispatcher.add_handler(ChosenInlineResultHandler(inline_chosen))
+    dispatcher.add_handler(MessageHandler(Filters.command, unknown))
+    dispatcher.add_error_handler(error)
+
+def warm_up(threads=WARM_UP_THREADS):
+    """ Builds the lazy indexes of the loaded corpus and renders its spells, the tasks run in parallel threads """
+    if not threads:
+        return
+    current = spells.current
+
+    def renders():
+        with spells.pinned():
+            for spell in current:
+                render_spell(spell)
+                spell_button(spell)
+
+    tasks = {'names': lambda: current.completions, 'fulltext': lambda: current.fulltext, 'renders': renders}
+    if hasattr(type(current.index), 'damage'):
+        tasks['damage'] = lambda: current.index.damage
+
+    def run(name):
+        with phases.phase(f'warm up {name}'):
+            tasks[name]()
+    with ThreadPoolExecutor(threads, thread_name_prefix='warm-up') as executor:
+        for future in [executor.submit(run, x) for x in tasks]:
+            future.result()
+    phases.mark('warmed up')
 
 def main():
+    global outbox, user_settings
     bot = Bot(token=TOKEN)
-    updater = Updater(bot=bot, use_context=True)
+    if not WORKERS:
+        spells.start_loading(then=warm_up)
+        user_settings = SettingsStore(SETTINGS_DB).start()
+        outbox = Outbox().start()
+    if WEBHOOK_URL:
+        dispatcher = Dispatcher(bot, None, workers=1, use_context=True)
+    else:
+        updater = Updater(bot=bot, use_context=True)
+        dispatcher = updater.dispatcher
+    supervisor = None
+    if WORKERS:
+        from workers import Supervisor
+        supervisor = Supervisor(WORKERS).attach(dispatcher)
+    else:
+        register_metrics()
+        add_handlers(dispatcher)
+        if REFRESH_INTERVAL:
+            refresher = Refresher(spells, load_spells, interval=REFRESH_INTERVAL).start()
+            signal.signal(signal.SIGHUP, lambda *_: threading.Thread(target=refresher.refresh).start())
+    phases.mark('ready for commands')
+    if WEBHOOK_URL:
+        from urllib.parse import urlparse
+        from webhook import WebhookServer
+        bot.set_webhook(WEBHOOK_URL, max_connections=WebhookServer.MAX_IN_FLIGHT, secret_token=WEBHOOK_SECRET)
+        WebhookServer(dispatcher, host='0.0.0.0', port=WEBHOOK_PORT, path=urlparse(WEBHOOK_URL).path or '/',
+                      secret=WEBHOOK_SECRET).run()
+    else:
+        updater.start_polling()
+        updater.idle()
+    if supervisor:
+        supervisor.stop()
 
-    updater.dispatcher.add_handler(CommandHandler('start', help_msg))
-    updater.dispatcher.add_handler(CommandHandler('class', set_class, pass_args=True))
-    updater.dispatcher.add_handler(CommandHandler('spellnamed', spell_by_name, pass_args=True))
-    updater.dispatcher.add_handler(CommandHandler('spellsearch', spell_search, pass_args=True))
-    updater.dispatcher.add_handler(CommandHandler('settings', settings))
-    updater.dispatcher.add_handler(CommandHandler('help', help_msg))
-    updater.dispatcher.add_handler(CallbackQueryHandler(button))
-    updater.dispatcher.add_handler(MessageHandler(Filters.command, unknown))
 
-    updater.dispatcher.add_error_handler(error)
-    updater.start_polling()
-    updater.idle()
+def profile_startup():
+    """ --profile-startup: times the startup phases up to the warmed up corpus, without connecting to Telegram """
+    loading = spells.start_loading(then=warm_up)
+    with phases.phase('add handlers'):
+        add_handlers(Dispatcher(Bot(token=TOKEN), None, workers=1, use_context=True))
+    phases.mark('ready for commands')
+    loading.join()
+    print(phases.report())
 
 
 if __name__ == '__main__':
-    logger.info('Start Bot')
-    main()
+    if '--profile-startup' in sys.argv:
+        profile_startup()
+    else:
+        logger.info('Start Bot')
+        main()
@@ -1,14 +1,125 @@
+import atexit
+import importlib.util
 import logging
+import logging.handlers
+import os
+import queue
 import re
+import sys
+import threading
+import time
+from collections import OrderedDict
 from itertools import groupby
 
 
-def createLogger(name, lvl=logging.DEBUG):
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE = 10   # per-item debug messages of a loop, the rest are only counted
+
+_log_handler = None
+
+
+def _queue_handler() -> logging.Handler:
+    """
+    One handler for all the loggers. Records are put to a queue and written to stderr by a listener thread,
+    so a logging call never waits for the stream
+    """
+    global _log_handler
+    if _log_handler is None:
+        log_queue = queue.SimpleQueue()
+        stream = logging.StreamHandler()
+        stream.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        _log_handler = logging.handlers.QueueHandler(log_queue)
+    return _log_handler
+
+
+def createLogger(name, lvl=None):
+    """ lvl: a level name or number, LOG_LEVEL environment variable (INFO by default) if not set """
     logger = logging.getLogger(name)
-    logger.setLevel(lvl)
-    ch = logging.StreamHandler()
-    ch.setLevel(lvl)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    logger.setLevel(lvl or LOG_LEVEL)
+    handler = _queue_handler()
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
     return logger
+
+
+def lazy_module(name):
+    """
+    The module, imported on the first attribute access rather than now (see importlib.util.LazyLoader).
+    None when it is not installed
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def deep_sizeof(obj, seen=None) -> int:
+    """ Approximate size of an object with everything it refers to, in bytes """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(x, seen) for x in obj)
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    if hasattr(obj, '__slots__'):
+        size += sum(deep_sizeof(getattr(obj, s), seen) for s in obj.__slots__ if hasattr(obj, s))
+    return size
+
+
+class LRUCache:
+    """
+    Thread safe LRU cache with an optional time to live of entries, counts hits, misses and evictions
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            item = self.__data.get(key)
+            if item is not None and self.ttl is not None and time.monotonic() - item[1] > self.ttl:
+                del self.__data[key]
+                self.evictions += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self.__data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__data[key] = (value, time.monotonic())
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def stats(self) -> dict:
+        return {'size': len(self.__data), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,126 @@
+"""
+Dice expressions of the API damage tables ('4d4', '1d4 + MOD', '4d6 + 4d6', '700') compiled to min/mean/max,
+and the damage index answering range queries and ordering over them.
+
+Damage fields of the query language:
+    damage, min_damage, max_damage      mean (by default), min or max damage at the spell's own level
+    damage@3                            cast with a level 3 slot
+    damage@c5                           cast by a level 5 character (cantrips)
+"""
+import bisect
+import functools
+import re
+from collections import namedtuple
+
+DamageStats = namedtuple('DamageStats', 'min mean max')
+
+MOD = 0     # spellcasting ability modifier assumed for '+ MOD' terms
+BASE, SLOT, CHARACTER = 'base', 'slot', 'character'
+CHARACTER_LEVELS = range(1, 21)
+
+term_regex = re.compile(r'\s*([+-])?\s*(?:(\d*)d(\d+)|(\d+)|(mod))\s*', re.IGNORECASE)
+field_regex = re.compile(r'^(?:(min|mean|max)_)?damage(?:@(c)?(\d+))?$')
+
+
+class DiceError(ValueError):
+    pass
+
+
+@functools.lru_cache(maxsize=4096)
+def parse(expr: str) -> DamageStats:
+    """ '2d8 + 4d6' -> DamageStats(min=6, mean=23.0, max=48) """
+    low = mean = high = 0
+    pos = 0
+    expr = expr.strip()
+    while pos < len(expr):
+        match = term_regex.match(expr, pos)
+        if match is None or match.end() == pos or (pos and not match.group(1)):
+            raise DiceError(f'Wrong dice expression: {expr}')
+        sign, count, sides, number, mod = match.groups()
+        if sides:
+            count, sides = int(count or 1), int(sides)
+            term = (count, count * (sides + 1) / 2, count * sides)
+        else:
+            value = int(number) if number else MOD
+            term = (value, value, value)
+        if sign == '-':
+            low, mean, high = low - term[2], mean - term[1], high - term[0]
+        else:
+            low, mean, high = low + term[0], mean + term[1], high + term[2]
+        pos = match.end()
+    if not pos:
+        raise DiceError(f'Wrong dice expression: {expr}')
+    return DamageStats(low, mean, high)
+
+
+def parse_field(field: str):
+    """ 'damage@3' -> ('mean', 'slot', 3), None for not a damage field """
+    match = field_regex.match(field)
+    if match is None:
+        return None
+    stat, character, level = match.groups()
+    if level is None:
+        return (stat or 'mean', BASE, 0)
+    return (stat or 'mean', CHARACTER if character else SLOT, int(level))
+
+
+def levels(spell) -> dict:
+    """ {(kind, level): DamageStats} of a spell, empty for spells without damage tables """
+    res = {}
+    by_slot = _parse_table(spell.damage_at_slot_level)
+    by_character = _parse_table(spell.damage_at_character_level)
+    for level, stats in by_slot.items():
+        res[(SLOT, level)] = stats
+    if by_character:
+        known = sorted(by_character)
+        for level in CHARACTER_LEVELS:
+            i = bisect.bisect_right(known, level)
+            if i:
+                res[(CHARACTER, level)] = by_character[known[i - 1]]
+    base = by_slot or by_character
+    if base:
+        res[(BASE, 0)] = base[min(base)]
+    return res
+
+
+def _parse_table(table) -> dict:
+    res = {}
+    for level, expr in (table or {}).items():
+        try:
+            res[int(level)] = parse(str(expr))
+        except (ValueError, DiceError):
+            continue
+    return res
+
+
+def damage_of(spell, stat, kind, level):
+    """ One stat of the spell damage or None """
+    stats = levels(spell).get((kind, level))
+    return getattr(stats, stat) if stats else None
+
+
+class DamageIndex:
+    """
+    Damage stats of a spell list sorted by value for every (stat, kind, level),
+    spell id is the position in the list
+    """
+    def __init__(self, spells):
+        self.__columns = {}     # (stat, kind, level) -> (sorted values, ids)
+        self.__values = {}      # (stat, kind, level) -> {spell id: value}
+        for spell_id, spell in enumerate(spells):
+            for (kind, level), stats in levels(spell).items():
+                for stat in DamageStats._fields:
+                    self.__values.setdefault((stat, kind, level), {})[spell_id] = getattr(stats, stat)
+        for key, values in self.__values.items():
+            pairs = sorted((v, spell_id) for spell_id, v in values.items())
+            self.__columns[key] = ([v for v, _ in pairs], [spell_id for _, spell_id in pairs])
+
+    def range(self, stat, kind, level, low=None, high=None, low_open=False, high_open=False) -> list:
+        """ Ids of spells with the stat in the range, ordered by the stat. None for an open end """
+        values, ids = self.__columns.get((stat, kind, level), ([], []))
+        start = 0 if low is None else (bisect.bisect_right if low_open else bisect.bisect_left)(values, low)
+        end = len(values) if high is None else (bisect.bisect_left if high_open else bisect.bisect_right)(values, high)
+        return ids[start:end]
+
+    def value(self, spell_id, stat, kind, level):
+        return self.__values.get((stat, kind, level), {}).get(spell_id)
@@ -1,16 +1,37 @@
-import requests
+import sqlite3
+import threading
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urljoin
+import base64
+import functools
+import hashlib
+import itertools
 import json
+import logging
+import os
+import random
 import re
+import sys
+import time
 
-from common import createLogger
+from common import LOG_SAMPLE, LRUCache, createLogger, lazy_module
+import dice
+from fulltext import FullTextIndex, Tokenizer
+from metrics import timed
+from name_index import Completions, NameIndex
+
+# imported on the first use: numpy is needed for big corpora only (see SpellTable), requests for API calls only
+np = lazy_module('numpy')
+requests = lazy_module('requests')
 
 logger = createLogger(__name__)
 
 
 def debug(handler):
     def inner(*args, **kwargs):
-        logger.debug(f'In {handler.__name__}()')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('In %s()', handler.__name__)
         return handler(*args, **kwargs)
     return inner
 
@@ -19,10 +40,16 @@ class DndSpellsError(Exception):
 
 class DndSpellsRequestError(DndSpellsError):
     def __init__(self, body):
-        self.body = json.loads(body)
-        self.status = self.body["error"]["status"]
-        self.message = self.body["error"]["message"]
-        self.reason = self.body["error"].get("reason")
+        try:
+            self.body = json.loads(body)
+        except json.decoder.JSONDecodeError:
+            self.body = {"error": body}
+        error = self.body.get("error") if isinstance(self.body, dict) else None
+        if not isinstance(error, dict):
+            error = {"status": None, "message": error}
+        self.status = error.get("status")
+        self.message = error.get("message")
+        self.reason = error.get("reason")
     def __str__(self):
         return f'{self.body}'
 
@@ -39,36 +66,467 @@ class CantParse(DndSpellsError):
     def __str__(self):
         return f'Wrong query string to parse: {self.q}'
 
+class QueryNode:
+    """
+    Compiled query plan node. A node is answered either by the index (ids) or by checking spells one by one (match).
+    index is a SpellIndex or anything with the same interface (DBIndex)
+    """
+    def indexed(self, index) -> bool:
+        return False
+
+    def estimate(self, index) -> int:
+        """ How many spells the node is expected to select """
+        return len(index.spells)
+
+    def ids(self, index) -> set:
+        raise NotImplementedError
+
+    def bitmap(self, table):
+        """ Boolean NumPy array of the fitting spells, for an indexed node over a SpellTable """
+        raise NotImplementedError
+
+    def match(self, spell) -> bool:
+        raise NotImplementedError
+
+
+class QueryEq(QueryNode):
+    """ field = value, or 'value in field' for list fields """
+    def __init__(self, field, value):
+        self.field = field
+        self.value = norm(value)
+
+    def indexed(self, index):
+        return self.field in index.fields
+
+    def estimate(self, index):
+        if not self.indexed(index):
+            return len(index.spells)
+        return len(index.lookup(self.field, self.value))
+
+    def ids(self, index):
+        return index.lookup(self.field, self.value)
+
+    def bitmap(self, table):
+        return table.mask(self.field, self.value)
+
+    def match(self, spell):
+        return spell.fits(self.field, self.value)
+
+    def __str__(self):
+        # quoted, the text of a plan is the key of cached results (see Spells.fingerprint)
+        return f'{self.field}={json.dumps(self.value)}'
+
+
+class QueryRange(QueryNode):
+    """ low <= field <= high, None for an open end. Non-numeric values never match """
+    def __init__(self, field, low=None, high=None):
+        self.field = field
+        self.low = low
+        self.high = high
+
+    def __fits(self, value) -> bool:
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            return False
+        return (self.low is None or value >= self.low) and (self.high is None or value <= self.high)
+
+    def indexed(self, index):
+        return self.field in index.fields
+
+    def estimate(self, index):
+        if not self.indexed(index):
+            return len(index.spells)
+        return sum(len(index.lookup(self.field, x)) for x in index.values(self.field) if self.__fits(x))
+
+    def ids(self, index):
+        return set().union(*(index.lookup(self.field, x) for x in index.values(self.field) if self.__fits(x)))
+
+    def bitmap(self, table):
+        return table.mask_any(self.field, [x for x in table.values(self.field) if self.__fits(x)])
+
+    def match(self, spell):
+        value = spell.normed(self.field)
+        if isinstance(value, frozenset):
+            return any(self.__fits(x) for x in value)
+        return self.__fits(value)
+
+    def __str__(self):
+        return f'{self.field} in {self.low}..{self.high}'
+
+
+class QueryDamage(QueryNode):
+    """ low <= damage stat <= high (strict with low_open/high_open), see dice for the damage fields """
+    def __init__(self, field, low=None, high=None, low_open=False, high_open=False):
+        self.field = field
+        self.key = dice.parse_field(field)
+        self.low = low
+        self.high = high
+        self.low_open = low_open
+        self.high_open = high_open
+
+    def __fits(self, value) -> bool:
+        if value is None:
+            return False
+        if self.low is not None and (value <= self.low if self.low_open else value < self.low):
+            return False
+        return self.high is None or (value < self.high if self.high_open else value <= self.high)
+
+    def indexed(self, index):
+        return hasattr(index, 'damage')
+
+    def estimate(self, index):
+        if not self.indexed(index):
+            return len(index.spells)
+        return len(self.__range(index))
+
+    def __range(self, index) -> list:
+        return index.damage.range(*self.key, self.low, self.high, self.low_open, self.high_open)
+
+    def ids(self, index):
+        return set(self.__range(index))
+
+    def bitmap(self, table):
+        res = np.zeros(table.count, dtype=bool)
+        res[self.__range(table)] = True
+        return res
+
+    def match(self, spell):
+        return self.__fits(dice.damage_of(spell, *self.key))
+
+    def __str__(self):
+        low = '(' if self.low_open else '['
+        high = ')' if self.high_open else ']'
+        return f'{self.field} in {low}{self.low}..{self.high}{high}'
+
+
+class QueryNot(QueryNode):
+    def __init__(self, child):
+        self.child = child
+
+    def indexed(self, index):
+        return self.child.indexed(index)
+
+    def estimate(self, index):
+        return len(index.spells) - self.child.estimate(index)
+
+    def ids(self, index):
+        return set(range(len(index.spells))) - self.child.ids(index)
+
+    def bitmap(self, table):
+        return ~self.child.bitmap(table)
+
+    def match(self, spell):
+        return not self.child.match(spell)
+
+    def __str__(self):
+        return f'!{self.child}'
+
+
+class QueryAnd(QueryNode):
+    def __init__(self, children):
+        self.children = children
+
+    def indexed(self, index):
+        return all(x.indexed(index) for x in self.children)
+
+    def estimate(self, index):
+        return min(x.estimate(index) for x in self.children)
+
+    def ids(self, index):
+        # the most selective clause first, so the candidates set shrinks as fast as possible
+        children = sorted(self.children, key=lambda x: x.estimate(index))
+        res = set(children[0].ids(index))
+        for child in children[1:]:
+            if not res:
+                break
+            res &= child.ids(index)
+        return res
+
+    def bitmap(self, table):
+        res = self.children[0].bitmap(table)
+        for child in self.children[1:]:
+            res = res & child.bitmap(table)
+        return res
+
+    def match(self, spell):
+        return all(x.match(spell) for x in self.children)
+
+    def __str__(self):
+        return '(' + ' & '.join(str(x) for x in self.children) + ')'
+
+
+class QueryOr(QueryNode):
+    def __init__(self, children):
+        self.children = children
+
+    def indexed(self, index):
+        return all(x.indexed(index) for x in self.children)
+
+    def estimate(self, index):
+        return min(len(index.spells), sum(x.estimate(index) for x in self.children))
+
+    def ids(self, index):
+        return set().union(*(x.ids(index) for x in self.children))
+
+    def bitmap(self, table):
+        res = self.children[0].bitmap(table)
+        for child in self.children[1:]:
+            res = res | child.bitmap(table)
+        return res
+
+    def match(self, spell):
+        return any(x.match(spell) for x in self.children)
+
+    def __str__(self):
+        return '(' + ' | '.join(str(x) for x in self.children) + ')'
+
+
+class Query:
+    """
+    Compiled query: a plan of QueryNode, see Parser
+    """
+    def __init__(self, root: QueryNode, text=None, order=None):
+        """
+        order: (field, descending) to sort the result by, the corpus order if None
+        """
+        self.root = root
+        self.text = text
+        self.order = order
+
+    def with_filters(self, filters: dict) -> 'Query':
+        """ The query AND field = value for every filter """
+        if not filters:
+            return self
+        eqs = [QueryEq(Parser.FIELD_ALIASES.get(f, f), v) for f, v in filters.items()]
+        return Query(QueryAnd([self.root] + eqs), self.text, self.order)
+
+    def execute(self, index) -> list:
+        """
+        Returns sorted ids of fitting spells.
+        Clauses answered by the index are intersected in order of their estimated selectivity,
+        the rest of clauses are checked on the remaining candidates only.
+        With order the ids are sorted by it, spells without the field value go last.
+        """
+        root = self.root
+        if root.indexed(index):
+            ids = self.__ids(root, index)
+        else:
+            if isinstance(root, QueryAnd):
+                indexed = [x for x in root.children if x.indexed(index)]
+                rest = [x for x in root.children if not x.indexed(index)]
+                candidates = self.__ids(QueryAnd(indexed), index) if indexed else range(len(index.spells))
+            else:
+                rest = [root]
+                candidates = range(len(index.spells))
+            ids = [x for x in candidates if all(node.match(index.spells[x]) for node in rest)]
+        return self.__sorted(ids, index) if self.order else ids
+
+    def __sorted(self, ids, index) -> list:
+        field, descending = self.order
+        if (key := dice.parse_field(field)) is not None:
+            if hasattr(index, 'damage'):
+                value = lambda x: index.damage.value(x, *key)
+            else:
+                value = lambda x: dice.damage_of(index.spells[x], *key)
+        else:
+            def value(x):
+                res = index.spells[x].normed(field)
+                return int(res) if isinstance(res, str) and res.isdigit() else res
+        values = [(value(x), x) for x in ids]
+        present = [(v, x) for v, x in values if v is not None and not isinstance(v, (frozenset, dict))]
+        present.sort(key=lambda pair: (isinstance(pair[0], str), pair[0]), reverse=descending)
+        missing = [x for v, x in values if v is None or isinstance(v, (frozenset, dict))]
+        return [x for _, x in present] + missing
+
+    @staticmethod
+    def __ids(node, index) -> list:
+        if isinstance(index, SpellTable):
+            return np.flatnonzero(node.bitmap(index)).tolist()
+        return sorted(node.ids(index))
+
+    def __str__(self):
+        if self.order:
+            return f'{self.root} sort {self.order[0]}{" desc" if self.order[1] else ""}'
+        return str(self.root)
+
+
 class Parser(Singleton):
     """
-    root ::= value
-    value ::= string | filter | '&'
-    filter ::= string '=' value
+    root    ::= or ['sort' field ['desc']]
+    or      ::= and ('|' and)*
+    and     ::= unary (['&'] unary)*
+    unary   ::= '!' unary | '(' or ')' | filter
+    filter  ::= field op value | field 'in' int '..' int | field 'has' value
+    op      ::= '=' | '!=' | '<' | '<=' | '>' | '>='
+    value   ::= word+ | '"' string '"'
+
+    Examples: level=2 & ritual=true, level<=3, level in 1..3, (school=evocation | school=necromancy) & !concentration=true,
+    components has M, damage_type=fire & damage@3 >= 20 sort damage@3 desc
+    Damage fields (damage, min_damage, max_damage, damage@<slot>, damage@c<character level>) are described in dice.
+    Compiled queries are cached by the normalized query text. Nesting of '!' and parentheses is limited to MAX_DEPTH.
     """
+    FIELD_ALIASES = {'class': 'classes'}
+    MAX_DEPTH = 100
+    COMPARISONS = ('=', '!=', '<', '<=', '>', '>=')
+    token_regex = re.compile(r'\s*(?:"([^"]*)"|(\.\.|!=|<=|>=|[=<>&|!()])|([\w@\'-]+))')
 
     @classmethod
-    def __call__(cls, q):
-        result = {}
-        while q:
-            try:
-                field, value, q = list(cls.__parse_filter(q))
-            except TypeError:
+    def __call__(cls, q) -> Query:
+        return cls.compile(' '.join(q.lower().split()))
+
+    @classmethod
+    @functools.lru_cache(maxsize=1024)
+    def compile(cls, q) -> Query:
+        tokens = cls.__tokenize(q)
+        pos, root = cls.__parse_or(q, tokens, 0)
+        order = None
+        if cls.__peek(tokens, pos) == ('word', 'sort'):
+            kind, field = cls.__peek(tokens, pos + 1)
+            field = cls.FIELD_ALIASES.get(field, field)
+            if kind != 'word' or (field not in Spell.FIELDS and dice.parse_field(field) is None):
+                raise CantParse(q)
+            pos += 2
+            descending = cls.__peek(tokens, pos) == ('word', 'desc')
+            pos += descending
+            order = (field, descending)
+        if pos != len(tokens):
+            raise CantParse(q)
+        return Query(root, q, order)
+
+    @classmethod
+    def __tokenize(cls, q) -> list:
+        """ [(kind, value)], kind is 'str' for quoted strings, 'op' or 'word' """
+        tokens, pos = [], 0
+        while pos < len(q):
+            match = cls.token_regex.match(q, pos)
+            if match is None or match.end() == pos:
+                if q[pos:].strip():
+                    raise CantParse(q)
+                break
+            string, op, word = match.groups()
+            if string is not None:
+                tokens.append(('str', string))
+            elif op is not None:
+                tokens.append(('op', op))
+            else:
+                tokens.append(('word', word))
+            pos = match.end()
+        return tokens
+
+    @staticmethod
+    def __peek(tokens, pos, offset=0):
+        return tokens[pos + offset] if pos + offset < len(tokens) else (None, None)
+
+    @classmethod
+    def __parse_or(cls, q, tokens, pos, depth=0):
+        pos, node = cls.__parse_and(q, tokens, pos, depth)
+        children = [node]
+        while cls.__peek(tokens, pos) == ('op', '|'):
+            pos, node = cls.__parse_and(q, tokens, pos + 1, depth)
+            children.append(node)
+        return pos, children[0] if len(children) == 1 else QueryOr(children)
+
+    @classmethod
+    def __parse_and(cls, q, tokens, pos, depth):
+        pos, node = cls.__parse_unary(q, tokens, pos, depth)
+        children = [node]
+        while pos < len(tokens) and cls.__peek(tokens, pos) not in (('op', '|'), ('op', ')'), ('word', 'sort')):
+            if cls.__peek(tokens, pos) == ('op', '&'):
+                pos += 1
+            pos, node = cls.__parse_unary(q, tokens, pos, depth)
+            children.append(node)
+        return pos, children[0] if len(children) == 1 else QueryAnd(children)
+
+    @classmethod
+    def __parse_unary(cls, q, tokens, pos, depth):
+        if depth > cls.MAX_DEPTH:
+            # the plan is walked recursively as well
+            raise CantParse(q)
+        token = cls.__peek(tokens, pos)
+        if token == ('op', '!'):
+            pos, node = cls.__parse_unary(q, tokens, pos + 1, depth + 1)
+            return pos, QueryNot(node)
+        if token == ('op', '('):
+            pos, node = cls.__parse_or(q, tokens, pos + 1, depth + 1)
+            if cls.__peek(tokens, pos) != ('op', ')'):
                 raise CantParse(q)
-            result.update({field: value})
-        return result
+            return pos + 1, node
+        return cls.__parse_filter(q, tokens, pos)
 
     @classmethod
-    def __parse_filter(cls, q):
-        filter_regex = re.compile(r'(\w+)\s*=\s*([a-zA-Z0-9_ ]*)\s*(.*)')
-        match = filter_regex.search(q)
-        if match is not None:
-            field, value, remainds = match.groups()
-            return field.strip(), value.strip(), remainds
+    def __starts_filter(cls, tokens, pos) -> bool:
+        kind, value = cls.__peek(tokens, pos + 1)
+        return (kind == 'op' and value in cls.COMPARISONS) or (kind == 'word' and value in ('in', 'has'))
 
-# class DBCarier(Singleton):
-#     @classmethod
-#     def __call__(cls):
-#         print('DB Worker')
+    @classmethod
+    def __parse_value(cls, q, tokens, pos):
+        kind, value = cls.__peek(tokens, pos)
+        if kind == 'str':
+            return pos + 1, value
+        words = []
+        while cls.__peek(tokens, pos)[0] == 'word' and not (words and (
+                cls.__starts_filter(tokens, pos) or tokens[pos][1] == 'sort')):
+            words.append(tokens[pos][1])
+            pos += 1
+        if not words:
+            raise CantParse(q)
+        return pos, ' '.join(words)
+
+    @classmethod
+    def __parse_int(cls, q, tokens, pos):
+        kind, value = cls.__peek(tokens, pos)
+        if kind != 'word' or not value.isdigit():
+            raise CantParse(q)
+        return pos + 1, int(value)
+
+    @classmethod
+    def __parse_filter(cls, q, tokens, pos):
+        kind, field = cls.__peek(tokens, pos)
+        field = cls.FIELD_ALIASES.get(field, field)
+        if kind == 'word' and dice.parse_field(field) is not None:
+            return cls.__parse_damage(q, tokens, pos, field)
+        if kind != 'word' or field not in Spell.FIELDS:
+            raise CantParse(q)
+        kind, op = cls.__peek(tokens, pos + 1)
+        pos += 2
+        if (kind, op) == ('word', 'in'):
+            pos, low = cls.__parse_int(q, tokens, pos)
+            if cls.__peek(tokens, pos) != ('op', '..'):
+                raise CantParse(q)
+            pos, high = cls.__parse_int(q, tokens, pos + 1)
+            return pos, QueryRange(field, low, high)
+        if (kind, op) == ('word', 'has'):
+            pos, value = cls.__parse_value(q, tokens, pos)
+            return pos, QueryEq(field, value)
+        if kind != 'op' or op not in cls.COMPARISONS:
+            raise CantParse(q)
+        if op in ('=', '!='):
+            pos, value = cls.__parse_value(q, tokens, pos)
+            node = QueryEq(field, value)
+            return pos, node if op == '=' else QueryNot(node)
+        pos, value = cls.__parse_int(q, tokens, pos)
+        bounds = {'<': (None, value - 1), '<=': (None, value), '>': (value + 1, None), '>=': (value, None)}
+        return pos, QueryRange(field, *bounds[op])
+
+    @classmethod
+    def __parse_damage(cls, q, tokens, pos, field):
+        """ Damage stats are not whole numbers, so the bounds keep their strictness """
+        kind, op = cls.__peek(tokens, pos + 1)
+        pos += 2
+        if (kind, op) == ('word', 'in'):
+            pos, low = cls.__parse_int(q, tokens, pos)
+            if cls.__peek(tokens, pos) != ('op', '..'):
+                raise CantParse(q)
+            pos, high = cls.__parse_int(q, tokens, pos + 1)
+            return pos, QueryDamage(field, low, high)
+        if kind != 'op' or op not in cls.COMPARISONS:
+            raise CantParse(q)
+        pos, value = cls.__parse_int(q, tokens, pos)
+        bounds = {'=': (value, value), '!=': (value, value), '<': (None, value, False, True), '<=': (None, value),
+                  '>': (value, None, True), '>=': (value, None)}
+        node = QueryDamage(field, *bounds[op])
+        return pos, QueryNot(node) if op == '!=' else node
 
 class Normalizer(Singleton):
     @classmethod
@@ -116,35 +574,199 @@ class Normalizer(Singleton):
         return cls.str_norm(str(obj))
 
 class APICarier(Singleton):
+    """
+    Fetches spells concurrently over a pool of keep-alive connections.
+    Every fetched spell is appended to checkpoint_path, so an interrupted fetch resumes from there.
+    """
     API_SPELLS_URL = 'https://www.dnd5eapi.co/api/spells/'
+    CONCURRENCY = 8
+    TIMEOUT = 10
+    RETRIES = 3
+    BACKOFF = 0.5
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    checkpoint_path = '.cached-spells.partial'
+
+    _session = None
+
+    @classmethod
+    def session(cls) -> 'requests.Session':
+        if cls._session is None:
+            cls._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=cls.CONCURRENCY)
+            cls._session.mount('http://', adapter)
+            cls._session.mount('https://', adapter)
+        return cls._session
 
     @classmethod
     def get_spells(cls) -> dict:
+        """
+        Returns {'spells': [...], 'versions': {index: version}, 'index_version': version},
+        version is {'etag': ..., 'last_modified': ..., 'hash': ...} of the API response
+        """
         logger.info('Getting data from API')
 
-        _spells = cls.__api_request(cls.API_SPELLS_URL).json()
+        indexes, index_version = cls.get_index()
+
+        fetched = cls.__load_checkpoint()
+        if fetched:
+            logger.info(f'Resuming from {cls.checkpoint_path}: {len(fetched)} spells fetched before')
+        fetched.update(cls.__fetch_spells({x: None for x in indexes if x not in fetched}, checkpoint=True))
 
-        spells = []
-        for spell in _spells['results']:
-            spells.append(
-                cls.__api_request(
-                    urljoin(cls.API_SPELLS_URL, spell['index'])
-                ).json()
-            )
-        return {'spells': spells}
+        os.remove(cls.checkpoint_path)
+        return {
+            'spells': [fetched[x][0] for x in indexes],
+            'versions': {x: fetched[x][1] for x in indexes},
+            'index_version': index_version,
+        }
 
     @classmethod
-    def __api_request(cls, url):
-        logger.info(f'API request to {url}')
+    def sync(cls, cached: dict, check_existing=False) -> tuple:
+        """
+        Brings cached spells up to date fetching only new and changed ones.
+        cached: cache contents, {'spells': [...], 'versions': {...}, 'index_version': ...}
+        check_existing: also revalidate the cached spells with conditional requests (a request per spell,
+            but an unchanged one is a bodyless 304), otherwise only the index is compared
+        Returns (spells in the get_spells format, {'added': [...], 'changed': [...], 'removed': [...]})
+        """
+        logger.info('Syncing data with API')
+        cached_spells = {x['index']: x for x in cached['spells']}
+        versions = cached.get('versions') or {}
+        diff = {'added': [], 'changed': [], 'removed': []}
+
+        indexes, index_version = cls.get_index(cached.get('index_version'))
+        if indexes is None:
+            indexes = list(cached_spells)
+        diff['added'] = [x for x in indexes if x not in cached_spells]
+        _indexes = set(indexes)
+        diff['removed'] = [x for x in cached_spells if x not in _indexes]
+
+        to_fetch = {x: None for x in diff['added']}
+        if check_existing:
+            to_fetch.update({x: versions.get(x) for x in indexes if x in cached_spells})
+        fetched = cls.__fetch_spells(to_fetch)
+
+        res = {'spells': [], 'versions': {}, 'index_version': index_version}
+        for index in indexes:
+            spell, version = fetched.get(index) or (None, versions.get(index))
+            if spell is None:
+                spell = cached_spells[index]
+            elif index in cached_spells:
+                if not versions.get(index) and cls.__same_spell(spell, cached_spells[index]):
+                    # cached before the versions were kept
+                    spell = cached_spells[index]
+                else:
+                    diff['changed'].append(index)
+            res['spells'].append(spell)
+            res['versions'][index] = version
+        logger.info(f"Synced: {len(diff['added'])} added, {len(diff['changed'])} changed, {len(diff['removed'])} removed")
+        return res, diff
+
+    @staticmethod
+    def __same_spell(spell: dict, cached_spell: dict) -> bool:
+        """ Cached spells are normalized with None for missing fields """
+        return {k: v for k, v in spell.items() if v is not None} == \
+            {k: v for k, v in cached_spell.items() if v is not None}
+
+    @classmethod
+    def get_index(cls, version=None) -> tuple:
+        """ Returns (spell indexes, version) or (None, version) if the index has not changed since the version """
+        resp = cls.__api_request(cls.API_SPELLS_URL, version)
+        if resp.status_code == 304:
+            return None, version
+        return [x['index'] for x in resp.json()['results']], cls.__version(resp)
+
+    @classmethod
+    def get_spell(cls, index, version=None) -> tuple:
+        """ Returns (spell, version) or (None, version) if the spell has not changed since the version """
+        resp = cls.__api_request(urljoin(cls.API_SPELLS_URL, index), version)
+        if resp.status_code == 304:
+            return None, version
+        return resp.json(), cls.__version(resp)
+
+    @classmethod
+    def __version(cls, resp) -> dict:
+        return {
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'hash': hashlib.sha1(resp.content).hexdigest(),
+        }
+
+    @classmethod
+    def __fetch_spells(cls, versions: dict, checkpoint=False) -> dict:
+        """
+        versions: {index: version the spell is cached with or None}
+        Returns {index: (spell, version)} for the spells that are new or changed
+        """
+        fetched = {}
+        with open(cls.checkpoint_path if checkpoint else os.devnull, 'a') as checkpoint_file, \
+                ThreadPoolExecutor(max_workers=cls.CONCURRENCY) as executor:
+            futures = {executor.submit(cls.get_spell, x, v): x for x, v in versions.items()}
+            try:
+                for future in as_completed(futures):
+                    spell, version = future.result()
+                    if spell is None:
+                        continue
+                    if version['hash'] == (versions[futures[future]] or {}).get('hash'):
+                        # the server does not support conditional requests but the spell is the same
+                        continue
+                    fetched[futures[future]] = (spell, version)
+                    checkpoint_file.write(json.dumps([spell, version]) + '\n')
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        return fetched
+
+    @classmethod
+    def __load_checkpoint(cls) -> dict:
+        fetched = {}
         try:
-            resp = requests.get(url)
-            resp.raise_for_status()
-        except requests.exceptions.HTTPError as err:
+            with open(cls.checkpoint_path, 'r') as f:
+                for line in f:
+                    try:
+                        spell, version = json.loads(line)
+                    except (json.decoder.JSONDecodeError, ValueError):
+                        # the line being written when the fetch was interrupted
+                        continue
+                    fetched[spell['index']] = (spell, version)
+        except IOError:
+            pass
+        return fetched
+
+    @classmethod
+    def __api_request(cls, url, version=None):
+        logger.info(f'API request to {url}')
+        headers = {}
+        if version:
+            if version.get('etag'):
+                headers['If-None-Match'] = version['etag']
+            if version.get('last_modified'):
+                headers['If-Modified-Since'] = version['last_modified']
+        for attempt in range(cls.RETRIES + 1):
+            last_attempt = attempt == cls.RETRIES
+            try:
+                resp = cls.session().get(url, headers=headers, timeout=cls.TIMEOUT)
+                if resp.status_code in cls.RETRY_STATUSES and not last_attempt:
+                    raise requests.exceptions.RetryError(f'{resp.status_code} for {url}')
+                resp.raise_for_status()
+                return resp
+            except requests.exceptions.HTTPError as err:
                 logger.error(err)
                 raise DndSpellsRequestError(resp.text)
-        return resp
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.RetryError) as err:
+                if last_attempt:
+                    logger.error(err)
+                    raise DndSpellsRequestError(str(err))
+                delay = random.uniform(0, cls.BACKOFF * 2 ** attempt)
+                logger.warning(f'{err}, retry in {delay:.2f}s')
+                time.sleep(delay)
 
 class CacheCarier(Singleton):
+    """
+    JSON file cache: {'spells': [...], 'versions': {index: version}, 'index_version': version}
+    Versions are API response validators used by the incremental update, see APICarier.sync
+    """
     cache_path = '.cached-spells'
 
     @classmethod
@@ -159,6 +781,11 @@ class CacheCarier(Singleton):
             logger.warning(f'Can not get data from {cls.cache_path}: {e}')
         return cached_spells
 
+    @classmethod
+    def raw(cls) -> dict:
+        """ The JSON cache contents with the versions, the input of APICarier.sync """
+        return cls.get_spells()
+
     @classmethod
     def cache(cls, spells: dict):
         logger.info('Cache data')
@@ -170,18 +797,555 @@ class CacheCarier(Singleton):
 
 norm = Normalizer()
 
+class SpellIndex:
+    """
+    Inverted index over the filterable fields of a spell list.
+    postings: {field: {normalized value: {spell id, ...}}}, spell id is the position in the list
+    """
+    FIELDS = ('name', 'index', 'level', 'school', 'classes', 'subclass', 'ritual', 'concentration',
+              'damage_type', 'dexterity_type', 'components', 'attack_type', 'casting_time', 'duration', 'range')
+
+    def __init__(self, spells, columns=None):
+        """
+        columns: {field: normalized values of the spells}, when given the index is built without touching
+            the spells, so a lazy spell sequence (e.g. SpellSnapshot) stays undecoded
+        """
+        self.spells = spells
+        self.postings = {field: {} for field in self.FIELDS}
+        for field in self.FIELDS:
+            values = columns[field] if columns else (spell.normed(field) for spell in spells)
+            field_postings = self.postings[field]
+            for spell_id, value in enumerate(values):
+                if value is None or isinstance(value, dict):
+                    continue
+                for x in (value if isinstance(value, frozenset) else [value]):
+                    if isinstance(x, str):
+                        field_postings.setdefault(x, set()).add(spell_id)
+        self.__damage = None
+
+    @property
+    def damage(self) -> dice.DamageIndex:
+        """ Built on the first damage query """
+        if self.__damage is None:
+            self.__damage = dice.DamageIndex(self.spells)
+        return self.__damage
+
+    @property
+    def fields(self):
+        return self.postings.keys()
+
+    def values(self, field):
+        """ Normalized values of the field """
+        return self.postings[field].keys()
+
+    def lookup(self, field, value) -> set:
+        return self.postings[field].get(norm(value), set())
+
+    def query(self, filters: dict) -> list:
+        """
+        Returns sorted ids of spells fitting all the filters.
+        Indexed filters are answered by posting sets intersection (smallest set first),
+        the rest of filters are checked with Spell.is_fit on the remaining candidates only.
+        """
+        postings, rest = [], {}
+        for f_key, f_val in filters.items():
+            if f_key in self.postings and isinstance(f_val, (str, int)):
+                postings.append(self.lookup(f_key, f_val))
+            else:
+                rest[f_key] = f_val
+
+        if postings:
+            postings.sort(key=len)
+            ids = set(postings[0])
+            for posting in postings[1:]:
+                if not ids:
+                    break
+                ids &= posting
+            ids = sorted(ids)
+        else:
+            ids = range(len(self.spells))
+
+        if rest:
+            rest = [(f_key, norm(f_val)) for f_key, f_val in rest.items()]
+            ids = [x for x in ids if all(self.spells[x].fits(f_key, f_val) for f_key, f_val in rest)]
+        return list(ids)
+
+class SpellTable:
+    """
+    Columnar index over the same fields as SpellIndex, filters run as vectorized NumPy masks.
+    Scalar fields are int32 codes into the sorted field values (-1 for none), list fields are bitmasks
+    (uint64 words, a bit per value), level is also kept as numbers for sorting.
+    Spells are touched only for filters on not indexed fields, so a lazy spell sequence stays undecoded.
+    Needs numpy.
+    """
+    LIST_WORD = 64
+
+    def __init__(self, spells, columns=None):
+        """
+        columns: {field: normalized values of the spells}, see SpellIndex
+        """
+        if np is None:
+            raise DndSpellsError('SpellTable needs numpy')
+        self.spells = spells
+        self.count = len(spells)
+        self.codes = {}     # scalar field -> int32 array
+        self.bits = {}      # list field -> uint64 array (count, words)
+        self.__values = {}
+        self.__positions = {}
+        for field in SpellIndex.FIELDS:
+            column = columns[field] if columns else [spell.normed(field) for spell in spells]
+            self.__add_column(field, column)
+        numbers = [int(x) if x.isdigit() else -1 for x in self.__values['level']]
+        self.level = np.array(numbers + [-1], dtype=np.int16)[self.codes['level']]
+        self.__damage = None
+
+    @property
+    def damage(self) -> dice.DamageIndex:
+        """ Built on the first damage query """
+        if self.__damage is None:
+            self.__damage = dice.DamageIndex(self.spells)
+        return self.__damage
+
+    def __add_column(self, field, column):
+        if hasattr(column, 'starts') and hasattr(column, 'codes'):
+            return self.__add_csr_column(field, column)
+        is_list = False
+        values = set()
+        for x in column:
+            if isinstance(x, frozenset):
+                is_list = True
+                values.update(v for v in x if isinstance(v, str))
+            elif isinstance(x, str):
+                values.add(x)
+        values = sorted(values)
+        positions = {v: i for i, v in enumerate(values)}
+        self.__values[field] = values
+        self.__positions[field] = positions
+        if not is_list:
+            self.codes[field] = np.fromiter((positions.get(x, -1) if isinstance(x, str) else -1 for x in column),
+                                            dtype=np.int32, count=self.count)
+            return
+        words = max(1, -(-len(values) // self.LIST_WORD))
+        masks = [sum(1 << positions[v] for v in x if isinstance(v, str)) if isinstance(x, frozenset) else 0
+                 for x in column]
+        bits = np.zeros((self.count, words), dtype=np.uint64)
+        for word in range(words):
+            shift = word * self.LIST_WORD
+            bits[:, word] = np.fromiter(((x >> shift) & 0xFFFFFFFFFFFFFFFF for x in masks),
+                                        dtype=np.uint64, count=self.count)
+        self.bits[field] = bits
+
+    def __add_csr_column(self, field, column):
+        """ A snapshot Column (CSR arrays of value codes) is converted as a whole, without decoding the rows """
+        values = sorted(column.values)
+        positions = {v: i for i, v in enumerate(values)}
+        self.__values[field] = values
+        self.__positions[field] = positions
+        starts = np.frombuffer(column.starts, dtype=np.uint32).astype(np.int64)
+        rank = np.array([positions[v] for v in column.values], dtype=np.int64)
+        codes = rank[np.frombuffer(column.codes, dtype=np.uint32)] if len(column.codes) else np.zeros(0, np.int64)
+        rows = np.repeat(np.arange(self.count), np.diff(starts))
+        if not column.is_list:
+            self.codes[field] = np.full(self.count, -1, dtype=np.int32)
+            self.codes[field][rows] = codes
+            return
+        bits = np.zeros((self.count, max(1, -(-len(values) // self.LIST_WORD))), dtype=np.uint64)
+        np.bitwise_or.at(bits, (rows, codes // self.LIST_WORD),
+                         np.left_shift(np.uint64(1), (codes % self.LIST_WORD).astype(np.uint64)))
+        self.bits[field] = bits
+
+    @property
+    def fields(self):
+        return self.__positions.keys()
+
+    def values(self, field):
+        """ Normalized values of the field """
+        return self.__values[field]
+
+    def mask(self, field, value):
+        """ Boolean array, True for spells with the (normalized) value """
+        pos = self.__positions[field].get(value)
+        if pos is None:
+            return np.zeros(self.count, dtype=bool)
+        if field in self.bits:
+            bit = np.uint64(1 << (pos % self.LIST_WORD))
+            return (self.bits[field][:, pos // self.LIST_WORD] & bit) != 0
+        return self.codes[field] == pos
+
+    def mask_any(self, field, values):
+        """ Boolean array, True for spells with any of the (normalized) values """
+        positions = [self.__positions[field][x] for x in values if x in self.__positions[field]]
+        if field not in self.bits:
+            return np.isin(self.codes[field], positions)
+        bits = self.bits[field]
+        words = np.zeros(bits.shape[1], dtype=np.uint64)
+        for pos in positions:
+            words[pos // self.LIST_WORD] |= np.uint64(1 << (pos % self.LIST_WORD))
+        return (bits & words).any(axis=1)
+
+    def lookup(self, field, value) -> set:
+        return set(np.flatnonzero(self.mask(field, norm(value))).tolist())
+
+    def query(self, filters: dict) -> list:
+        """
+        Returns sorted ids of spells fitting all the filters, see SpellIndex.query.
+        Indexed filters are ANDed as masks, the rest are checked with Spell.fits on the remaining candidates.
+        """
+        mask, rest = None, []
+        for f_key, f_val in filters.items():
+            if f_key in self.__positions and isinstance(f_val, (str, int)):
+                field_mask = self.mask(f_key, norm(f_val))
+                mask = field_mask if mask is None else mask & field_mask
+            else:
+                rest.append((f_key, norm(f_val)))
+        ids = np.flatnonzero(mask).tolist() if mask is not None else range(self.count)
+        if rest:
+            ids = [x for x in ids if all(self.spells[x].fits(f_key, f_val) for f_key, f_val in rest)]
+        return list(ids)
+
+    def sort(self, ids, by='name') -> list:
+        """ Ids ordered by name, or by level and then name, without touching the spells """
+        ids = np.asarray(ids, dtype=np.int64)
+        names = self.codes['name'][ids]
+        if by == 'level':
+            order = np.lexsort((names, self.level[ids]))
+        elif by == 'name':
+            order = np.argsort(names, kind='stable')
+        else:
+            raise ValueError(f'Can not sort by {by}')
+        return ids[order].tolist()
+
+    def counts(self, field, ids=None) -> dict:
+        """ {value: number of spells with it} over the ids (all the spells by default) """
+        values = self.__values[field]
+        if field in self.bits:
+            bits = self.bits[field] if ids is None else self.bits[field][np.asarray(ids, dtype=np.int64)]
+            res = [int(np.count_nonzero(bits[:, pos // self.LIST_WORD] & np.uint64(1 << (pos % self.LIST_WORD))))
+                   for pos in range(len(values))]
+        else:
+            codes = self.codes[field] if ids is None else self.codes[field][np.asarray(ids, dtype=np.int64)]
+            res = np.bincount(codes[codes >= 0], minlength=len(values)).tolist()
+        return {v: n for v, n in zip(values, res) if n}
+
+class DBCarier(Singleton):
+    """
+    SQLite spell store. Filters and full text search run in SQL, so the corpus is never loaded as a whole
+    and one database file is shared by all the bot workers.
+    Filterable columns hold values normalized as Spell.normed does it, a spell itself is a JSON blob.
+    The database is built from the JSON cache when it is missing, older than the cache or of another SCHEMA_VERSION.
+    Damage stats (see dice) are precomputed per spell, kind and level, so damage clauses run in SQL too.
+    """
+    db_path = '.cached-spells.db'
+    SCHEMA_VERSION = 2
+    json_carier = CacheCarier()
+
+    SCALAR_FIELDS = ('name', 'index', 'level', 'school', 'ritual', 'concentration', 'damage_type',
+                     'dexterity_type', 'attack_type', 'casting_time', 'duration', 'range')
+    LIST_FIELDS = {'classes': 'spell_classes', 'subclass': 'spell_subclasses', 'components': 'spell_components'}
+    SCHEMA = [
+        'CREATE TABLE spells (id INTEGER PRIMARY KEY, {}, data TEXT NOT NULL)'.format(
+            ', '.join(f'"{x}" {"INTEGER" if x == "level" else "TEXT"}' for x in SCALAR_FIELDS)),
+        *[f'CREATE TABLE {x} (spell_id INTEGER NOT NULL REFERENCES spells(id), value TEXT NOT NULL)'
+          for x in LIST_FIELDS.values()],
+        'CREATE TABLE spell_damage (spell_id INTEGER NOT NULL REFERENCES spells(id), '
+        'kind TEXT NOT NULL, level INTEGER NOT NULL, min INTEGER NOT NULL, mean REAL NOT NULL, max INTEGER NOT NULL)',
+        *[f'CREATE INDEX spells_{x} ON spells("{x}")' for x in SCALAR_FIELDS],
+        *[f'CREATE INDEX {x}_value ON {x}(value, spell_id)' for x in LIST_FIELDS.values()],
+        'CREATE INDEX spell_damage_spell ON spell_damage(spell_id, kind, level)',
+        *[f'CREATE INDEX spell_damage_{x} ON spell_damage(kind, level, "{x}")' for x in dice.DamageStats._fields],
+        "CREATE VIRTUAL TABLE spells_fts USING fts5(name, desc, higher_level, tokenize='unicode61')",
+    ]
+
+    @classmethod
+    def get_spells(cls) -> dict:
+        logger.info('Getting data from database')
+        json_path = cls.json_carier.cache_path
+        try:
+            if not os.path.exists(cls.db_path) or cls.schema_version() != cls.SCHEMA_VERSION or (
+                    os.path.exists(json_path) and os.path.getmtime(json_path) > os.path.getmtime(cls.db_path)):
+                cached_spells = cls.json_carier.get_spells()
+                if not cached_spells or not cached_spells.get('spells'):
+                    return {}
+                cls.build(cached_spells)
+            db = SpellsDB(cls.db_path)
+        except sqlite3.Error as e:
+            logger.warning(f'Can not get data from {cls.db_path}: {e}')
+            return cls.json_carier.get_spells()
+        logger.info('Got database data')
+        return {'spells': db, 'index': DBIndex(db), 'fulltext': DBFullText(db), 'columns': {'name': db.names()}}
+
+    @classmethod
+    def raw(cls) -> dict:
+        """ The JSON cache the database is built from, get_spells() returns Spell objects without the versions """
+        return cls.json_carier.raw()
+
+    @classmethod
+    def cache(cls, spells: dict):
+        cls.json_carier.cache(spells)
+        try:
+            cls.build(spells)
+        except sqlite3.Error as e:
+            logger.warning(f'Can not save data in {cls.db_path}: {e}')
+
+    @classmethod
+    def schema_version(cls) -> int:
+        conn = sqlite3.connect(f'file:{cls.db_path}?mode=ro', uri=True)
+        try:
+            return conn.execute('PRAGMA user_version').fetchone()[0]
+        finally:
+            conn.close()
+
+    @classmethod
+    def build(cls, cached_spells: dict):
+        """ Builds a new database from the JSON cache contents and atomically replaces the old one """
+        tmp_path = f'{cls.db_path}.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            with conn:
+                for statement in cls.SCHEMA:
+                    conn.execute(statement)
+                columns = ', '.join(f'"{x}"' for x in cls.SCALAR_FIELDS)
+                insert_spell = f'INSERT INTO spells (id, {columns}, data) VALUES (?, {", ".join("?" * len(cls.SCALAR_FIELDS))}, ?)'
+                for spell_id, _spell in enumerate(cached_spells['spells']):
+                    spell = Spells.create_spell(dict(_spell))
+                    conn.execute(insert_spell, (spell_id, *[
+                        spell.level if x == 'level' else spell.normed(x) for x in cls.SCALAR_FIELDS
+                    ], json.dumps(spell.to_json())))
+                    for field, table in cls.LIST_FIELDS.items():
+                        conn.executemany(f'INSERT INTO {table} (spell_id, value) VALUES (?, ?)',
+                                         [(spell_id, x) for x in spell.normed(field) or ()])
+                    conn.executemany('INSERT INTO spell_damage (spell_id, kind, level, min, mean, max) '
+                                     'VALUES (?, ?, ?, ?, ?, ?)',
+                                     [(spell_id, kind, level, *stats)
+                                      for (kind, level), stats in dice.levels(spell).items()])
+                    conn.execute('INSERT INTO spells_fts (rowid, name, desc, higher_level) VALUES (?, ?, ?, ?)',
+                                 (spell_id, spell.name, spell.desc, spell.higher_level))
+                conn.execute('ANALYZE')
+                conn.execute(f'PRAGMA user_version = {cls.SCHEMA_VERSION}')
+        finally:
+            conn.close()
+        os.replace(tmp_path, cls.db_path)
+        logger.info(f"Built database {cls.db_path}: {len(cached_spells['spells'])} spells")
+
+
+class SpellsDB(Sequence):
+    """ Read-only sequence of Spell objects stored in a SQLite database, one connection per thread """
+    DECODED_CACHE_SIZE = 1024
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.__local = threading.local()
+        self.count = self.execute('SELECT count(*) FROM spells').fetchone()[0]
+        self.__decoded = {}
+
+    def execute(self, sql, params=()):
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = self.__local.conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True,
+                                                       check_same_thread=False)
+        return conn.execute(sql, params)
+
+    def names(self) -> list:
+        return [x for x, in self.execute('SELECT name FROM spells ORDER BY id')]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[x] for x in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        spell = self.__decoded.get(i)
+        if spell is None:
+            row = self.execute('SELECT data FROM spells WHERE id = ?', (i,)).fetchone()
+            if row is None:
+                raise IndexError(i)
+            spell = Spell(**json.loads(row[0]))
+            if len(self.__decoded) >= self.DECODED_CACHE_SIZE:
+                self.__decoded.pop(next(iter(self.__decoded)), None)
+            self.__decoded[i] = spell
+        return spell
+
+
+class DBDamage:
+    """ DamageIndex interface answered by SQL over the precomputed stats """
+    def __init__(self, db: SpellsDB):
+        self.spells = db
+
+    def range(self, stat, kind, level, low=None, high=None, low_open=False, high_open=False) -> list:
+        """ Ids of spells with the stat in the range, ordered by the stat. None for an open end """
+        where, params = ['kind = ?', 'level = ?'], [kind, level]
+        if low is not None:
+            where.append(f'"{stat}" {">" if low_open else ">="} ?')
+            params.append(low)
+        if high is not None:
+            where.append(f'"{stat}" {"<" if high_open else "<="} ?')
+            params.append(high)
+        return [x for x, in self.spells.execute(
+            f'SELECT spell_id FROM spell_damage WHERE {" AND ".join(where)} ORDER BY "{stat}", spell_id', params)]
+
+    def value(self, spell_id, stat, kind, level):
+        row = self.spells.execute(f'SELECT "{stat}" FROM spell_damage WHERE spell_id = ? AND kind = ? AND level = ?',
+                                  (spell_id, kind, level)).fetchone()
+        return row[0] if row else None
+
+
+class DBIndex:
+    """ SpellIndex interface answered by SQL """
+    fields = frozenset(DBCarier.SCALAR_FIELDS) | frozenset(DBCarier.LIST_FIELDS)
+
+    def __init__(self, db: SpellsDB):
+        self.spells = db
+        self.damage = DBDamage(db)
+
+    def __where(self, field) -> str:
+        if field in DBCarier.LIST_FIELDS:
+            return f'id IN (SELECT spell_id FROM {DBCarier.LIST_FIELDS[field]} WHERE value = ?)'
+        return f'"{field}" = ?'
+
+    def values(self, field):
+        if field in DBCarier.LIST_FIELDS:
+            return [x for x, in self.spells.execute(f'SELECT DISTINCT value FROM {DBCarier.LIST_FIELDS[field]}')]
+        return [x for x, in self.spells.execute(f'SELECT DISTINCT "{field}" FROM spells') if x is not None]
+
+    def lookup(self, field, value) -> set:
+        return set(x for x, in self.spells.execute(f'SELECT id FROM spells WHERE {self.__where(field)}', (norm(value),)))
+
+    def query(self, filters: dict) -> list:
+        where, params, rest = [], [], []
+        for f_key, f_val in filters.items():
+            if not isinstance(f_val, (str, int)):
+                rest.append((f_key, norm(f_val)))
+            elif f_key in self.fields:
+                where.append(self.__where(f_key))
+                params.append(norm(f_val))
+            else:
+                rest.append((f_key, norm(f_val)))
+        sql = 'SELECT id FROM spells'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        ids = [x for x, in self.spells.execute(sql + ' ORDER BY id', params)]
+        if rest:
+            ids = [x for x in ids if all(self.spells[x].fits(f_key, f_val) for f_key, f_val in rest)]
+        return ids
+
+
+class DBFullText:
+    """ FullTextIndex interface answered by SQLite FTS5, same query syntax """
+    phrase_regex = re.compile(r'"([^"]*)"')
+
+    def __init__(self, db: SpellsDB):
+        self.spells = db
+        self.tokenizer = Tokenizer()
+
+    def search(self, query: str) -> list:
+        phrases = [self.tokenizer(x) for x in self.phrase_regex.findall(query)]
+        words = self.tokenizer(self.phrase_regex.sub(' ', query))
+        match = ' '.join([f'"{x}"*' for x in words] + [f'"{" ".join(x)}"' for x in phrases if x])
+        if not match:
+            return []
+        rows = self.spells.execute(
+            'SELECT rowid, bm25(spells_fts, 3.0, 1.0, 1.0) AS rank FROM spells_fts '
+            'WHERE spells_fts MATCH ? ORDER BY rank, rowid', (match,))
+        return [(x, -rank) for x, rank in rows]
+
+
 class Spells:
+    RESULT_CACHE_SIZE = 1024
+    RESULT_CACHE_TTL = 3600
+    TABLE_MIN_SPELLS = 5000
+    _versions = itertools.count(1)
+
     def __init__(self, spells=None, cache_carier=CacheCarier()):
         self.__api_carier = APICarier()
         self.__cache_carier = cache_carier
+        self.__results = LRUCache(self.RESULT_CACHE_SIZE, self.RESULT_CACHE_TTL)
+        self.__popularity = {}
+        self.__ranking = threading.Lock()
         self.spells = spells
         self._cursor = -1
 
-    def update_cache(self):
-        spells = self.__normalize(
-            self.__api_carier.get_spells()
-        )
-        self.__cache_carier.cache(spells)
+    @property
+    def index(self) -> SpellIndex:
+        if self.__index is None:
+            self.__index = self.__make_index()
+        return self.__index
+
+    def __make_index(self, columns=None):
+        """ SpellTable for big corpora when numpy is installed, SpellIndex otherwise """
+        if np is not None and len(self.__spells) >= self.TABLE_MIN_SPELLS:
+            return SpellTable(self.__spells, columns)
+        return SpellIndex(self.__spells, columns)
+
+    @property
+    def fulltext(self) -> FullTextIndex:
+        if self.__fulltext is None:
+            self.__fulltext = FullTextIndex(self.__spells)
+        return self.__fulltext
+
+    @property
+    def names(self) -> NameIndex:
+        if self.__names is None:
+            names = self.__columns['name'] if self.__columns else [x.normed('name') for x in self.__spells]
+            self.__names = NameIndex(list(names))
+        return self.__names
+
+    @property
+    def completions(self) -> Completions:
+        completions = self.__completions
+        if completions is None:
+            completions = self.__completions = self.__make_completions(self.names)
+        return completions
+
+    def __make_completions(self, names: NameIndex) -> Completions:
+        return Completions(names.names, [self.__popularity.get(x, 0) for x in names.names])
+
+    def warm(self) -> 'Spells':
+        """ Builds the lazy indexes now, so the first queries do not pay for them """
+        self.completions    # builds names too
+        self.fulltext
+        if hasattr(self.index, 'damage'):
+            self.index.damage
+        return self
+
+    def set_popularity(self, popularity: dict):
+        """
+        popularity: {normalized spell name: weight}, name completions are ranked by it.
+        Built completions are re-ranked in a background thread and swapped in, the old ones answer meanwhile
+        """
+        self.__popularity = dict(popularity)
+        if self.__completions is not None:
+            threading.Thread(target=self.__rerank, name='rerank', daemon=True).start()
+
+    def __rerank(self):
+        # one at a time, so the last swapped in has the latest popularity
+        with self.__ranking:
+            names = self.names
+            completions = self.__make_completions(names)
+            if self.__names is names:   # not a new corpus meanwhile
+                self.__completions = completions
+
+    def update_cache(self, incremental=True, check_existing=False, reload=True) -> dict:
+        """
+        Rewrites the cache with the data from API. Incremental update fetches only new and changed spells
+        (see APICarier.sync), the full one re-downloads everything. If anything has changed and reload is set
+        the spells are reloaded from the cache in place, so it is for a Spells no other thread queries: the live
+        corpus of the bot is updated by Refresher.update_cache, which swaps a rebuilt Spells in.
+        Returns {'added': [...], 'changed': [...], 'removed': [...]}
+        """
+        cached = self.__cache_carier.raw() if incremental else None
+        if cached and cached.get('spells'):
+            spells, diff = self.__api_carier.sync(cached, check_existing)
+        else:
+            spells = self.__api_carier.get_spells()
+            diff = {'added': [x['index'] for x in spells['spells']], 'changed': [], 'removed': []}
+        self.__cache_carier.cache(self.__normalize(spells))
+        if reload and any(diff.values()):
+            self.spells = None
+        return diff
 
     @property
     def spells(self):
@@ -189,62 +1353,140 @@ class Spells:
 
     @spells.setter
     def spells(self, _spells=None):
+        self.__index = None
+        self.__fulltext = None
+        self.__names = None
+        self.__completions = None
+        self.__columns = None
+        # a new corpus invalidates all the cached results
+        self.__results.clear()
+        self.version = next(self._versions)
         if _spells:
             assert isinstance(_spells, list)
             if isinstance(_spells[0], Spell):
                 self.__spells = _spells
             elif isinstance(_spells[0], dict):
                 self.__spells = [self.create_spell(x) for x in _spells]
+                self.__index = self.__make_index()
         else:
             if _spells == []:
                 self.__spells = []
             else:
                 spells = self.__cache_carier.get_spells()
-                if not spells:
+                if not spells or not spells.get('spells'):
                     spells = self.__normalize(
                         self.__api_carier.get_spells()
                     )
                     self.__cache_carier.cache(spells)
-                self.__spells = [self.create_spell(x) for x in spells['spells']]
+                if isinstance(spells['spells'], list):
+                    self.__spells = [self.create_spell(x) for x in spells['spells']]
+                else:
+                    # a lazy sequence of Spell objects with precomputed normalized columns (see SnapshotCarier)
+                    # and maybe with its own query engines (see DBCarier)
+                    self.__spells = spells['spells']
+                    self.__columns = spells.get('columns')
+                    self.__fulltext = spells.get('fulltext')
+                self.__index = spells.get('index') or self.__make_index(self.__columns)
+
+    def __cached(self, key, query) -> list:
+        """
+        Query results are cached as lists of spell ids (or (id, score) pairs)
+        query: function computing the result on a cache miss
+        """
+        res = self.__results.get(key)
+        if res is None:
+            res = query()
+            self.__results.put(key, res)
+        return res
+
+    def cache_stats(self) -> dict:
+        return self.__results.stats()
+
+    def __query_key(self, filters) -> tuple:
+        if isinstance(filters, Query):
+            return ('query', str(filters))
+        if 'desc_search' in filters:
+            return ('desc', ' '.join(filters['desc_search'].lower().split()))
+        return ('filters', tuple(sorted(
+            (k, norm(v) if isinstance(v, (str, int)) else repr(v)) for k, v in filters.items())))
+
+    def fingerprint(self, filters) -> str:
+        """ Short id of a query, the same for equivalent queries (e.g. for Telegram callback data) """
+        digest = hashlib.sha1(repr(self.__query_key(filters)).encode()).digest()
+        return base64.urlsafe_b64encode(digest[:9]).decode()
+
+    @timed('spell_query', slow_log=True, method=True)
+    def select(self, filters) -> list:
+        """
+        Ids (positions) of the spells fitting the filters, see get_spells_by.
+        Ids are in the corpus order, or best matches first for the text search
+        """
+        if isinstance(filters, Query):
+            logger.debug('Query: %s', filters)
+            return self.__cached(self.__query_key(filters), lambda: filters.execute(self.index))
+        if 'desc_search' in filters:
+            return [x for x, _ in self.__search(filters['desc_search'])]
+        if 'class' in filters:
+            filters = {**filters}
+            filters['classes'] = filters.pop('class')
+        logger.debug('Filters: %s', filters)
+        return self.__cached(self.__query_key(filters), lambda: self.index.query(filters))
+
+    def __search(self, search_strings) -> list:
+        key = self.__query_key({'desc_search': search_strings})
+        return self.__cached(key, lambda: self.fulltext.search(search_strings))
 
     @debug
+    @timed('spell_query', slow_log=True, method=True)
     def search_by_desc(self, search_strings):
-        res_spells = []
-        for spell in self.__spells:
-            if spell.desc.lower().find(search_strings.lower()) != -1 or spell.name.lower().find(search_strings.lower()) != -1:
-                res_spells.append(spell)
-                logger.debug(f'Found a spell: {spell}')
-        return Spells(spells=res_spells)
+        """
+        Full text search over name, desc and higher_level, best matches first
+        """
+        found = self.__search(search_strings)
+        if logger.isEnabledFor(logging.DEBUG):
+            for spell_id, score in found[:LOG_SAMPLE]:
+                logger.debug('Found a spell: %s (%.2f)', self.__spells[spell_id], score)
+            logger.debug('Found %d spells', len(found))
+        return Spells(spells=[self.__spells[x] for x, _ in found])
 
     @debug
+    @timed('spell_query', slow_log=True, method=True)
     def get_spells_by(self, filters):
-        if 'desc_search' in filters:
+        """
+        filters: {field: value} or a Query compiled by Parser
+        """
+        if isinstance(filters, dict) and 'desc_search' in filters:
             return self.search_by_desc(filters['desc_search'])
-        if 'class' in filters:
-            filters['classes'] = filters.pop('class')
-        logger.debug(f'Filters: {filters}')
-        res_spells = []
-        for spell in self.__spells:
-            if spell.is_fit(filters):
-                # logger.debug(f'Found a spell: {spell}')
-                res_spells.append(spell)
-        return Spells(spells=res_spells)
+        return Spells(spells=[self.__spells[x] for x in self.select(filters)])
+
+    @timed('spell_query', slow_log=True, method=True)
+    def get_spell(self, index):
+        """ A spell by its index field (e.g. 'acid-arrow') or None """
+        ids = self.index.lookup('index', norm(index))
+        return self.__spells[min(ids)] if ids else None
 
     @debug
-    def get_spells_by_name(self, name):
-        logger.debug(f'Searching for {name}')
+    @timed('spell_query', slow_log=True, method=True)
+    def get_spells_by_name(self, name, limit=None):
+        """
+        Exact name match, otherwise spells with the name in their names, otherwise the most alike names
+        """
+        return Spells(spells=[spell for spell, _ in self.match_names(name, limit)])
+
+    @timed('spell_query', slow_log=True, method=True)
+    def match_names(self, name, limit=None) -> list:
+        """
+        Returns [(spell, similarity score), ...], best matches first. See NameIndex for the score meaning.
+        """
+        logger.debug('Searching for %s', name)
         _name = norm(name)
+        found = self.__cached(('name', _name, limit), lambda: self.names.search(_name, limit))
+        return [(self.__spells[x], score) for x, score in found]
 
-        res_spell = self.get_spells_by({'name': _name})
-        if res_spell:
-            return res_spell
-        else:
-            logger.debug(f"Can't find a spell named {name}. Searching for something alike")
-            res_spells = []
-            for s in self.spells:
-                if _name in norm(s.name):
-                    res_spells.append(s)
-            return Spells(spells=res_spells)
+    @timed('spell_query', slow_log=True, method=True)
+    def complete_names(self, prefix, limit=None) -> list:
+        """ Spells with the name or a word of it starting with the prefix, the most popular first """
+        return [self.__spells[x] for x in self.completions.complete(norm(prefix), limit)]
 
     @classmethod
     def create_spell(cls, normed_spell: dict):
@@ -283,7 +1525,7 @@ class Spells:
         _all_fields = [list(spell.keys()) for spell in spells['spells']]
         all_fields = set([field for fields in _all_fields for field in fields])
 
-        normalized_spells = {'spells': []}
+        normalized_spells = {**spells, 'spells': []}
 
         for spell in spells['spells']:
             spell_tmp = {f: spell.get(f) for f in all_fields}
@@ -308,6 +1550,9 @@ class Spells:
     def __len__(self):
         return len(self.spells)
 
+    def __getitem__(self, spell_id):
+        return self.__spells[spell_id]
+
     def to_json(self):
         res = {'spells': []}
         for spell in self.spells:
@@ -315,11 +1560,81 @@ class Spells:
         return res
 
 class Spell:
+    """
+    Fixed schema spell. Fields missing in the source data are None, unknown (homebrew) fields go to _extra.
+    Normalized forms of the filterable fields are computed once at creation:
+    a str for scalar values and a frozenset for lists.
+    """
+    FIELDS = ('level', 'heal_at_slot_level', 'components', 'attack_type', 'index', 'ritual', 'range',
+              'school', 'concentration', 'casting_time', 'duration', 'material', 'url', 'name',
+              'area_of_effect', 'classes', 'desc', 'higher_level', 'subclass', 'damage_type',
+              'damage_at_slot_level', 'damage_at_character_level', 'dexterity_type', 'dexterity_success',
+              'dexterity_desc')
+    NORMED_FIELDS = SpellIndex.FIELDS
+    INTERNED_FIELDS = ('components', 'attack_type', 'school', 'casting_time', 'duration', 'range',
+                       'classes', 'subclass', 'damage_type', 'dexterity_type', 'dexterity_success')
+    __slots__ = FIELDS + ('_extra', '_normed')
+
+    _normed_pos = {f: i for i, f in enumerate(NORMED_FIELDS)}
+    _shared_sets = {}
+
     def __init__(self, **fields):
-        for f in fields: setattr(self, f, fields[f])
+        for f in self.FIELDS:
+            value = fields.pop(f, None)
+            if f in self.INTERNED_FIELDS:
+                value = self.__intern(value)
+            object.__setattr__(self, f, value)
+        self._extra = fields or None
+        self._normed = tuple(self.__normalize(getattr(self, f, None)) for f in self.NORMED_FIELDS)
+
+    @staticmethod
+    def __intern(value):
+        if isinstance(value, str):
+            return sys.intern(value)
+        if isinstance(value, list):
+            return [sys.intern(x) if isinstance(x, str) else x for x in value]
+        return value
+
+    @classmethod
+    def __normalize(cls, value):
+        if value is None or isinstance(value, dict):
+            return value
+        if isinstance(value, list):
+            normed = frozenset(sys.intern(x) if isinstance(x, str) else x for x in norm(value))
+            # the same class and component sets repeat across spells, keep one copy of each
+            return cls._shared_sets.setdefault(normed, normed)
+        return sys.intern(norm(value))
+
+    def __getattr__(self, name):
+        # called only when there is no such slot or it was never set
+        if name.startswith('_'):
+            raise AttributeError(name)
+        extra = self._extra
+        if extra and name in extra:
+            return extra[name]
+        raise AttributeError(f"'Spell' object has no attribute '{name}'")
+
+    def normed(self, field):
+        """ Normalized value of the field, cached for the filterable fields """
+        if (pos := self._normed_pos.get(field)) is not None:
+            return self._normed[pos]
+        return self.__normalize(getattr(self, field))
 
     def to_json(self) -> dict:
-        return {x: self.__dict__[x] for x in self.__dict__}
+        res = {f: getattr(self, f) for f in self.FIELDS}
+        if self._extra:
+            res.update(self._extra)
+        return res
+
+    def fits(self, field, normed_value) -> bool:
+        """ normed_value: filter value normalized with Normalizer """
+        obj_val = self.normed(field)
+        if isinstance(obj_val, frozenset):
+            try:
+                return normed_value in obj_val
+            except TypeError:
+                return False
+        return normed_value == obj_val
 
     def is_fit(self, filter: dict):
         """
@@ -328,14 +1643,8 @@ class Spell:
         """
 
         for f_key, f_val in filter.items():
-            obj_val = norm(getattr(self, f_key))
-
-            if isinstance(obj_val, list):
-                if norm(f_val) not in obj_val:
-                    return False
-            else:
-                if norm(f_val) != obj_val:
-                    return False
+            if not self.fits(f_key, norm(f_val)):
+                return False
         return True
 
     def str_nice(self):
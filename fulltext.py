@@ -0,0 +1,133 @@
+import math
+import re
+import time
+from bisect import bisect_left
+
+from common import createLogger, deep_sizeof
+
+logger = createLogger(__name__)
+
+
+class Tokenizer:
+    token_regex = re.compile(r'[a-z0-9]+')
+
+    def __call__(self, text: str) -> list:
+        if not text:
+            return []
+        return self.token_regex.findall(text.lower())
+
+
+class FullTextIndex:
+    """
+    Inverted index with positional postings and BM25 ranking over spell name, desc and higher_level.
+    postings: {term: {doc_id: [position, ...]}}
+
+    Fields of a document share one position space: name tokens go first and every next field
+    starts after a gap, so phrases never match across field borders.
+
+    Query syntax:
+        fire damage         documents with all the terms, terms match as prefixes ("fire" finds "fireball" too)
+        "sphere of fire"    phrase
+    """
+    FIELDS = ('name', 'desc', 'higher_level')
+    FIELD_GAP = 2
+    NAME_BOOST = 3
+    PREFIX_WEIGHT = 0.5
+    K1 = 1.2
+    B = 0.75
+
+    phrase_regex = re.compile(r'"([^"]*)"')
+
+    def __init__(self, spells: list, tokenizer=None):
+        started = time.perf_counter()
+        self.tokenizer = tokenizer or Tokenizer()
+        self.postings = {}
+        self.doc_len = []
+        self.name_len = []
+        for doc_id, spell in enumerate(spells):
+            pos = 0
+            for field in self.FIELDS:
+                tokens = self.tokenizer(getattr(spell, field, None))
+                if field == 'name':
+                    self.name_len.append(len(tokens))
+                for token in tokens:
+                    self.postings.setdefault(token, {}).setdefault(doc_id, []).append(pos)
+                    pos += 1
+                pos += self.FIELD_GAP
+            self.doc_len.append(pos)
+        self.docs_count = len(self.doc_len)
+        self.avg_doc_len = (sum(self.doc_len) / self.docs_count) if self.docs_count else 0
+        self.vocabulary = sorted(self.postings)
+        self.build_time = time.perf_counter() - started
+        logger.debug(f'Full text index: {self.docs_count} docs, {len(self.vocabulary)} terms, built in {self.build_time:.3f}s')
+
+    def __expand(self, term: str) -> list:
+        """ All the known terms starting with the term, the exact one included """
+        terms = []
+        i = bisect_left(self.vocabulary, term)
+        while i < len(self.vocabulary) and self.vocabulary[i].startswith(term):
+            terms.append(self.vocabulary[i])
+            i += 1
+        return terms
+
+    def __has_phrase(self, doc_id, phrase: list) -> bool:
+        first, *rest = [self.postings[t][doc_id] for t in phrase]
+        rest = [set(x) for x in rest]
+        return any(all(p + i in positions for i, positions in enumerate(rest, 1)) for p in first)
+
+    def __term_score(self, doc_id, term, norm_len) -> float:
+        positions = self.postings[term].get(doc_id)
+        if not positions:
+            return 0.0
+        in_name = bisect_left(positions, self.name_len[doc_id])
+        tf = len(positions) + (self.NAME_BOOST - 1) * in_name
+        df = len(self.postings[term])
+        idf = math.log(1 + (self.docs_count - df + 0.5) / (df + 0.5))
+        return idf * tf * (self.K1 + 1) / (tf + norm_len)
+
+    def __score(self, doc_id, groups: list, exact: set) -> float:
+        """ BM25, every query term scores by its best matching expansion """
+        norm_len = self.K1 * (1 - self.B + self.B * self.doc_len[doc_id] / self.avg_doc_len)
+        return sum(
+            max((1 if t in exact else self.PREFIX_WEIGHT) * self.__term_score(doc_id, t, norm_len) for t in g)
+            for g in groups)
+
+    def search(self, query: str) -> list:
+        """
+        Returns [(doc_id, score), ...] sorted by score, best matches first
+        """
+        phrases = [self.tokenizer(x) for x in self.phrase_regex.findall(query)]
+        phrases = [x for x in phrases if x]
+        words = self.tokenizer(self.phrase_regex.sub(' ', query))
+
+        groups = [self.__expand(t) for t in words]
+        groups += [[t] for phrase in phrases for t in phrase]
+        if not groups or not all(groups) or any(t not in self.postings for p in phrases for t in p):
+            return []
+
+        # every group is a union of postings, intersect them starting with the rarest one
+        doc_sets = sorted(
+            (set().union(*(self.postings[t] for t in g)) for g in groups), key=len)
+        docs = doc_sets[0]
+        for doc_set in doc_sets[1:]:
+            if not docs:
+                return []
+            docs &= doc_set
+
+        if phrases:
+            docs = [d for d in docs if all(self.__has_phrase(d, p) for p in phrases)]
+
+        exact = set(words) | set(t for p in phrases for t in p)
+        res = [(d, self.__score(d, groups, exact)) for d in docs]
+        res.sort(key=lambda x: (-x[1], x[0]))
+        return res
+
+    def stats(self) -> dict:
+        return {
+            'docs': self.docs_count,
+            'terms': len(self.vocabulary),
+            'postings': sum(len(x) for x in self.postings.values()),
+            'build_time_s': self.build_time,
+            'memory_bytes': deep_sizeof(self.postings) + deep_sizeof(self.doc_len)
+                + deep_sizeof(self.name_len) + deep_sizeof(self.vocabulary),
+        }
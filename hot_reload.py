@@ -0,0 +1,190 @@
+"""
+Hot reload of the corpus: a fresh Spells with all its indexes is built in a background thread, off the request path,
+and published with a single reference assignment. A handler pins the corpus it started with, so its queries and
+renders see one version even if a swap happens meanwhile; Spells.version tells the caches apart.
+
+    REFRESH_INTERVAL=60 python bot.py
+"""
+import contextlib
+import functools
+import os
+import threading
+import time
+
+import metrics
+from common import createLogger
+from dnd_spells import CacheCarier, DndSpellsError
+
+logger = createLogger(__name__)
+
+BUILD_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class NotReady(DndSpellsError):
+    pass
+
+
+class SpellsReference:
+    """
+    The live Spells. Attributes are read from the current Spells object, or from the one pinned by the thread.
+    Given a load function instead of Spells, the corpus is loaded on the first use, or in background by
+    start_loading(). While it is loaded in background the readers get NotReady at once: the handlers run on the
+    dispatcher thread, a handler waiting for the corpus would hold every update after it. A reader loading it on
+    the first use makes the others wait up to READY_TIMEOUT seconds
+    """
+    READY_TIMEOUT = 30
+
+    def __init__(self, spells=None, load=None):
+        self.__current = spells
+        self.__load = load
+        self.__loading = threading.Lock()
+        self.__in_background = False
+        self.__local = threading.local()
+
+    @property
+    def ready(self) -> bool:
+        return self.__current is not None
+
+    @property
+    def current(self):
+        pinned = getattr(self.__local, 'spells', None)
+        return self.__latest() if pinned is None else pinned
+
+    def __latest(self):
+        if self.__current is None:
+            if self.__in_background:
+                acquired = self.__loading.acquire(blocking=False)
+            else:
+                acquired = self.__loading.acquire(timeout=self.READY_TIMEOUT)
+            if not acquired:
+                raise NotReady('The spells are not loaded yet')
+            try:
+                if self.__current is None:
+                    self.__current = self.__load()
+            finally:
+                self.__loading.release()
+        return self.__current
+
+    def start_loading(self, then=None) -> threading.Thread:
+        """ Loads the corpus in a background thread, then calls then() """
+        def load():
+            try:
+                self.__latest()
+            except Exception as e:
+                logger.error(f'Can not load spells: {e}')
+                return
+            finally:
+                self.__in_background = False
+            if then is not None:
+                then()
+        self.__in_background = True
+        thread = threading.Thread(target=load, name='loader', daemon=True)
+        thread.start()
+        return thread
+
+    def swap(self, spells):
+        """ Publishes a new Spells, returns the previous one """
+        previous, self.__current = self.__current, spells
+        return previous
+
+    @contextlib.contextmanager
+    def pinned(self):
+        """ The thread sees the current Spells until the block ends, whatever is swapped in """
+        if getattr(self.__local, 'spells', None) is not None:
+            yield self.__local.spells
+            return
+        self.__local.spells = self.__latest()
+        try:
+            yield self.__local.spells
+        finally:
+            self.__local.spells = None
+
+    def pin(self, handler):
+        """ Decorator running the handler on one corpus version """
+        @functools.wraps(handler)
+        def inner(*args, **kwargs):
+            with self.pinned():
+                return handler(*args, **kwargs)
+        return inner
+
+    def __getattr__(self, name):
+        return getattr(self.current, name)
+
+    def __len__(self):
+        return len(self.current)
+
+    def __getitem__(self, key):
+        return self.current[key]
+
+
+def cache_version():
+    """ Version of the corpus source: the JSON cache modification time, the other stores are rebuilt from it """
+    try:
+        return os.path.getmtime(CacheCarier.cache_path)
+    except OSError:
+        return None
+
+
+class Refresher:
+    """
+    Watches the corpus source and swaps a rebuilt Spells in when it changes.
+    build: function returning a new Spells
+    version: function returning the source version, checked every interval seconds
+    warm: build the lazy indexes before the swap. The full text and damage indexes decode every spell, so it is
+        off for a lazily decoded snapshot shared by the workers
+    """
+    def __init__(self, reference: SpellsReference, build, version=cache_version, interval=60, warm=True):
+        self.reference = reference
+        self.build = build
+        self.version = version
+        self.interval = interval
+        self.warm = warm
+        self.__published = version()
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__seconds = metrics.registry.histogram('spells_reload_seconds', 'corpus reload duration', ('stage',),
+                                                    BUILD_BUCKETS)
+        self.__reloads = metrics.registry.counter('spells_reloads_total', 'corpus reloads', ('result',))
+        metrics.registry.gauge('spells_version', 'version of the live corpus',
+                               lambda: reference.version if reference.ready else 0)
+
+    def start(self) -> 'Refresher':
+        threading.Thread(target=self.__watch, name='refresher', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.__stopped.set()
+
+    def __watch(self):
+        while not self.__stopped.wait(self.interval):
+            if self.version() != self.__published:
+                self.refresh()
+
+    def update_cache(self, incremental=True, check_existing=False) -> dict:
+        """ Spells.update_cache for the live corpus: writes the new cache, then swaps a corpus rebuilt from it in """
+        diff = self.reference.current.update_cache(incremental, check_existing, reload=False)
+        if any(diff.values()):
+            self.refresh()
+        return diff
+
+    def refresh(self):
+        """ Builds the new corpus (with its indexes if warm) and swaps it in, the live one stays on failure """
+        with self.__lock:
+            version = self.version()
+            started = time.perf_counter()
+            try:
+                spells = self.build()
+                if self.warm:
+                    spells.warm()
+            except Exception as e:
+                self.__reloads.inc('failed')
+                logger.error(f'Can not reload spells: {e}')
+                return None
+            built = time.perf_counter()
+            self.reference.swap(spells)
+            self.__seconds.observe(built - started, 'build')
+            self.__seconds.observe(time.perf_counter() - built, 'swap')
+            self.__reloads.inc('ok')
+            self.__published = version
+            logger.info(f'Reloaded spells in {built - started:.2f} s: {len(spells)} spells, version {spells.version}')
+            return spells
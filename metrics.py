@@ -0,0 +1,201 @@
+import bisect
+import functools
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from common import createLogger
+
+logger = createLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 10000, 100000)
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, values)) + '}'
+
+
+class Histogram:
+    """ Prometheus histogram, one series per label values """
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.__series = {}   # label values -> [counts per bucket + inf, sum]
+        self.__lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            series = self.__series.get(labels)
+            if series is None:
+                series = self.__series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def expose(self) -> list:
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} histogram']
+        with self.__lock:
+            series = [(k, list(v[0]), v[1]) for k, v in self.__series.items()]
+        for values, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = _labels(self.labels + ('le',), values + (bound,))
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, values)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labels, values)} {cumulative}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.__values = {}
+        self.__lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self.__lock:
+            self.__values[labels] = self.__values.get(labels, 0) + value
+
+    def expose(self) -> list:
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} counter']
+        with self.__lock:
+            values = sorted(self.__values.items())
+        lines.extend(f'{self.name}{_labels(self.labels, k)} {v}' for k, v in values)
+        return lines
+
+
+class Gauge:
+    """
+    Value read on every scrape.
+    read: function returning a number, or {label value(s): number} for a gauge with labels
+    """
+    def __init__(self, name, doc, read, labels=()):
+        self.name = name
+        self.doc = doc
+        self.read = read
+        self.labels = tuple(labels)
+
+    def expose(self) -> list:
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} gauge']
+        try:
+            values = self.read()
+        except Exception as e:
+            logger.warning(f'Can not read {self.name}: {e}')
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for k, v in values.items():
+            lines.append(f'{self.name}{_labels(self.labels, k if isinstance(k, tuple) else (k,))} {v}')
+        return lines
+
+
+class Registry:
+    """
+    Metrics of the process, see timed() for the instrumentation and serve() for the HTTP endpoint.
+    Slow calls (over slow_seconds) are logged with their arguments, one of every slow_sample of them
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.slow_seconds = None
+        self.slow_sample = 1.0
+        self.__lock = threading.Lock()
+
+    def __add(self, metric):
+        with self.__lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def histogram(self, name, doc, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.__add(Histogram(name, doc, labels, buckets))
+
+    def counter(self, name, doc, labels=()) -> Counter:
+        return self.__add(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, read, labels=()) -> Gauge:
+        with self.__lock:
+            # gauges are replaced, so the last registered object is read
+            self.metrics[name] = Gauge(name, doc, read, labels)
+            return self.metrics[name]
+
+    def log_slow(self, seconds, sample=1.0):
+        """ seconds: None disables the slow calls log """
+        self.slow_seconds = seconds
+        self.slow_sample = sample
+
+    def timed(self, kind, slow_log=False, method=False):
+        """
+        Decorator recording <kind>_seconds and <kind>_results (len of the result, if it has one) histograms
+        and <kind>_errors_total, labelled by the function name.
+        slow_log: slow calls are logged with their arguments, see log_slow
+        method: the first argument (self) is left out of the slow calls log
+        """
+        seconds = self.histogram(f'{kind}_seconds', f'{kind} latency', ('name',))
+        results = self.histogram(f'{kind}_results', f'{kind} result size', ('name',), SIZE_BUCKETS)
+        errors = self.counter(f'{kind}_errors_total', f'{kind} failures', ('name',))
+
+        def decorator(func):
+            name = func.__name__
+
+            @functools.wraps(func)
+            def inner(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    res = func(*args, **kwargs)
+                except Exception:
+                    errors.inc(name)
+                    raise
+                finally:
+                    elapsed = time.perf_counter() - started
+                    seconds.observe(elapsed, name)
+                    if slow_log and self.slow_seconds is not None and elapsed >= self.slow_seconds \
+                            and random.random() < self.slow_sample:
+                        logged = args[1:] if method else args
+                        logger.warning(f'Slow {kind} {name}: {elapsed * 1000:.1f} ms, '
+                                       f'args: {", ".join(str(x) for x in logged)} {kwargs or ""}')
+                if hasattr(res, '__len__'):
+                    results.observe(len(res), name)
+                return res
+            return inner
+        return decorator
+
+    def expose(self) -> str:
+        with self.__lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.expose()) + '\n'
+
+    def serve(self, port, host='127.0.0.1') -> ThreadingHTTPServer:
+        """ Serves the metrics in Prometheus text format at http://host:port/metrics in a daemon thread """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.expose().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logger.info(f'Metrics at http://{host}:{server.server_port}/metrics')
+        return server
+
+
+registry = Registry()
+timed = registry.timed
@@ -0,0 +1,202 @@
+import re
+from bisect import bisect_left
+
+punctuation_regex = re.compile(r"[^\w ]")
+
+
+def edit_distance(a: str, b: str, limit=None) -> int:
+    """ Levenshtein distance. With a limit gives up early and returns limit + 1 when the distance is greater """
+    if len(a) < len(b):
+        a, b = b, a
+    if limit is not None and len(a) - len(b) > limit:
+        return limit + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if limit is not None and min(cur) > limit:
+            return limit + 1
+        prev = cur
+    return prev[-1]
+
+
+def trigrams(s: str) -> set:
+    s = f' {s} '
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+class NameIndex:
+    """
+    Name lookup over normalized names: exact match hash, sorted word prefixes and trigrams.
+    Every match comes with a similarity score:
+        1.0             exact match
+        0.75 .. 1.0     a name starting with the query
+        0.5 .. 0.75     a name containing the query
+        0.0 .. 0.5      misspelled name, by edit distance to the name or its tail
+    Fuzzy matching is done only when nothing contains the query.
+    """
+    FUZZY_SCORE = 0.5
+    MIN_SIMILARITY = 0.7
+    TAIL_WEIGHT = 0.9
+    FUZZY_CANDIDATES = 20
+
+    def __init__(self, names: list):
+        """ names: normalized names, the position of a name is its id """
+        self.names = names
+        self.exact = {}
+        self.prefixes = []
+        self.trigrams = {}
+        for name_id, name in enumerate(names):
+            self.exact.setdefault(name, []).append(name_id)
+            # every word start is a prefix entry, so 'arrow' finds 'acid arrow'
+            start = 0
+            for word in name.split(' '):
+                self.prefixes.append((name[start:], name_id))
+                start += len(word) + 1
+            for t in trigrams(name):
+                self.trigrams.setdefault(t, set()).add(name_id)
+        self.prefixes.sort()
+
+    def __contains_score(self, name_id, query) -> float:
+        name = self.names[name_id]
+        coverage = 0.25 * len(query) / len(name)
+        return (0.75 if name.startswith(query) else 0.5) + coverage
+
+    def __by_prefix(self, query) -> set:
+        found = set()
+        i = bisect_left(self.prefixes, (query,))
+        while i < len(self.prefixes) and self.prefixes[i][0].startswith(query):
+            found.add(self.prefixes[i][1])
+            i += 1
+        return found
+
+    def __by_substring(self, query) -> set:
+        """ Names containing the query: all its inner trigrams are in the name, then check it for sure """
+        postings = sorted((self.trigrams.get(query[i:i + 3], set()) for i in range(len(query) - 2)), key=len)
+        found = set(postings[0])
+        for posting in postings[1:]:
+            if not found:
+                break
+            found &= posting
+        return {x for x in found if query in self.names[x]}
+
+    def __similarity(self, query, s) -> float:
+        longest = max(len(query), len(s))
+        limit = int((1 - self.MIN_SIMILARITY) * longest)
+        return 1 - edit_distance(query, s, limit) / longest
+
+    def __fuzzy(self, query) -> list:
+        query_trigrams = trigrams(query)
+        counts = {}
+        for t in query_trigrams:
+            for name_id in self.trigrams.get(t, ()):
+                counts[name_id] = counts.get(name_id, 0) + 1
+        # an edit breaks at most 3 trigrams, names sharing too few of them are too far anyway
+        max_edits = int((1 - self.MIN_SIMILARITY) * len(query)) + 1
+        min_common = len(query_trigrams) - 3 * max_edits
+        candidates = sorted((x for x in counts if counts[x] >= min_common),
+                            key=lambda x: -counts[x])[:self.FUZZY_CANDIDATES]
+
+        res = []
+        for name_id in candidates:
+            name = self.names[name_id]
+            # a tail of the name ('fireball' of 'delayed blast fireball') is a weaker match than the name itself
+            similarity = max([self.__similarity(query, name)] + [
+                self.TAIL_WEIGHT * self.__similarity(query, name[i + 1:]) for i, c in enumerate(name) if c == ' '])
+            if similarity >= self.MIN_SIMILARITY:
+                res.append((name_id, self.FUZZY_SCORE * similarity))
+        return res
+
+    def search(self, query: str, limit=None) -> list:
+        """
+        query: normalized name
+        Returns [(id, score), ...] sorted by score, best matches first
+        """
+        if not query:
+            return []
+        if query in self.exact:
+            return [(x, 1.0) for x in self.exact[query]]
+
+        found = self.__by_prefix(query)
+        if len(query) >= 3:
+            found |= self.__by_substring(query)
+        else:
+            # no inner trigrams in a short query, scan the names
+            found |= {i for i, name in enumerate(self.names) if query in name}
+        res = [(x, self.__contains_score(x, query)) for x in found]
+        if not res:
+            res = self.__fuzzy(query)
+        res.sort(key=lambda x: (-x[1], self.names[x[0]]))
+        return res[:limit] if limit else res
+
+
+class Completions:
+    """
+    As-you-type completions of normalized names. The names and their aliases (the tail from every word start,
+    the name without punctuation) are kept in a sorted array, and the TOP best names of every prefix up to
+    MAX_PREFIX characters are precomputed, so a lookup costs a hash of the prefix whatever the corpus size.
+    A longer prefix is a binary search over the array, its range is small by then.
+    Names are ranked by popularity, then names starting with the prefix before the ones with a word starting
+    with it, then alphabetically.
+    """
+    TOP = 50
+    MAX_PREFIX = 12
+
+    def __init__(self, names: list, popularity=None):
+        """
+        names: normalized names, the position of a name is its id
+        popularity: weights of the names by id, the most popular first
+        """
+        self.names = names
+        popularity = popularity or [0] * len(names)
+        self.keys = []      # (alias, rank) sorted by alias
+        for name_id, name in enumerate(names):
+            for alias, word in self.aliases(name):
+                self.keys.append((alias, (-popularity[name_id], word, name, name_id)))
+        self.keys.sort()
+
+        ranks = {}
+        for alias, rank in self.keys:
+            for length in range(min(len(alias), self.MAX_PREFIX) + 1):
+                ranks.setdefault(alias[:length], []).append(rank)
+        self.top = {prefix: self.__best(x, self.TOP) for prefix, x in ranks.items()}
+
+    @staticmethod
+    def aliases(name) -> set:
+        """ {(alias, starts at a word of the name), ...} """
+        res = set()
+        for variant in {name, punctuation_regex.sub('', name)}:
+            words = variant.split(' ')
+            for i in range(len(words)):
+                res.add((' '.join(words[i:]), i > 0))
+        return res
+
+    @staticmethod
+    def __best(ranks, limit) -> tuple:
+        """ Name ids of the best ranks, every name once """
+        res = []
+        seen = set()
+        for rank in sorted(ranks):
+            if rank[-1] not in seen:
+                seen.add(rank[-1])
+                res.append(rank[-1])
+                if len(res) == limit:
+                    break
+        return tuple(res)
+
+    def complete(self, prefix: str, limit=None) -> list:
+        """
+        prefix: normalized name start, empty for the most popular names
+        Returns name ids, best first, at most TOP of them
+        """
+        if len(prefix) <= self.MAX_PREFIX:
+            found = self.top.get(prefix, ())
+        else:
+            i = bisect_left(self.keys, (prefix,))
+            ranks = []
+            while i < len(self.keys) and self.keys[i][0].startswith(prefix):
+                ranks.append(self.keys[i][1])
+                i += 1
+            found = self.__best(ranks, self.TOP)
+        return list(found[:limit] if limit else found)
@@ -0,0 +1,190 @@
+import heapq
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from common import LRUCache, createLogger
+
+logger = createLogger(__name__)
+
+
+def split_message(text: str, max_length: int) -> list:
+    """ Splits a text into parts not longer than max_length, preferably on line breaks, in one pass """
+    parts = []
+    start, length = 0, len(text)
+    while length - start > max_length:
+        cut = text.rfind('\n', start, start + max_length)
+        if cut > start:
+            parts.append(text[start:cut])
+            start = cut + 1
+        else:
+            parts.append(text[start:start + max_length])
+            start += max_length
+    parts.append(text[start:])
+    return parts
+
+
+class TokenBucket:
+    """ rate tokens per second, at most capacity tokens saved up for bursts """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """ Takes a token, returns how long to wait before using it """
+        with self.__lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def ready_in(self) -> float:
+        """ How long until a token is available, without taking it """
+        with self.__lock:
+            tokens = min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate)
+            return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+
+class Outbox:
+    """
+    Outbound calls to Telegram (send_message, edit_message_text, ...) done by a pool of worker threads.
+    Calls for a chat are done one at a time in the order they were submitted. Every chat is limited by its own
+    token bucket (Telegram allows about a message per second in a chat) and all of them by the global one
+    (about 30 messages per second). A chat waiting for its bucket does not hold a worker.
+    """
+    GLOBAL_RATE = 30
+    GLOBAL_BURST = 5
+    CHAT_RATE = 1
+    CHAT_BURST = 3
+    LATENCY_WINDOW = 1024
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, workers=4, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.__chats = {}           # chat_id -> deque of (future, func, args, kwargs, submitted)
+        # an evicted bucket belongs to a chat quiet for long, its bucket would be full anyway
+        self.__buckets = LRUCache(self.MAX_CHAT_BUCKETS)
+        self.__scheduled = []       # heap of (ready time, seq, chat_id), a chat is scheduled at most once
+        self.__seq = 0
+        self.__cond = threading.Condition()
+        self.__threads = []
+        self.__stopped = False
+        self.sent = self.failed = 0
+        self.latencies = deque(maxlen=self.LATENCY_WINDOW)
+
+    def start(self) -> 'Outbox':
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.__work, name=f'outbox-{i}', daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+        return self
+
+    def stop(self, wait=True):
+        """ Stops the workers, with wait first delivers everything queued """
+        with self.__cond:
+            while wait and self.__chats:
+                self.__cond.wait(0.05)
+            self.__stopped = True
+            self.__cond.notify_all()
+        for thread in self.__threads:
+            thread.join()
+
+    def submit(self, chat_id, func, *args, **kwargs) -> Future:
+        """ Queues func(*args, **kwargs) for the chat, returns a Future of its result """
+        future = Future()
+        with self.__cond:
+            queue = self.__chats.get(chat_id)
+            if queue is None:
+                queue = self.__chats[chat_id] = deque()
+                self.__schedule(chat_id, time.monotonic())
+            queue.append((future, func, args, kwargs, time.monotonic()))
+        return future
+
+    def __schedule(self, chat_id, ready_at):
+        self.__seq += 1
+        heapq.heappush(self.__scheduled, (ready_at, self.__seq, chat_id))
+        self.__cond.notify()
+
+    def __next_chat(self):
+        with self.__cond:
+            while not self.__stopped:
+                if self.__scheduled:
+                    ready_at, _, chat_id = self.__scheduled[0]
+                    delay = ready_at - time.monotonic()
+                    if delay <= 0:
+                        heapq.heappop(self.__scheduled)
+                        return chat_id
+                    self.__cond.wait(delay)
+                else:
+                    self.__cond.wait()
+        return None
+
+    def __work(self):
+        while (chat_id := self.__next_chat()) is not None:
+            bucket = self.__buckets.get(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                self.__buckets.put(chat_id, bucket)
+            delay = bucket.ready_in()
+            if delay > 0:
+                with self.__cond:
+                    self.__schedule(chat_id, time.monotonic() + delay)
+                continue
+            bucket.reserve()
+            time.sleep(self.global_bucket.reserve())
+
+            with self.__cond:
+                future, func, args, kwargs, submitted = self.__chats[chat_id][0]
+            retry_after = None
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                # telegram.error.RetryAfter: flood control, try again later
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after is None:
+                    logger.error(f'Can not deliver to {chat_id}: {e}')
+                    self.failed += 1
+                    future.set_exception(e)
+            else:
+                self.sent += 1
+                self.latencies.append(time.monotonic() - submitted)
+                future.set_result(result)
+
+            with self.__cond:
+                queue = self.__chats[chat_id]
+                if retry_after is not None:
+                    logger.warning(f'Flood control for {chat_id}, retry in {retry_after}s')
+                    self.__schedule(chat_id, time.monotonic() + float(retry_after))
+                    continue
+                queue.popleft()
+                if queue:
+                    self.__schedule(chat_id, time.monotonic())
+                else:
+                    del self.__chats[chat_id]
+                    self.__cond.notify_all()
+
+    def queue_depth(self) -> int:
+        with self.__cond:
+            return sum(len(x) for x in self.__chats.values())
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+        return {
+            'queue_depth': self.queue_depth(),
+            'chats': len(self.__chats),
+            'sent': self.sent,
+            'failed': self.failed,
+            'latency_p50_s': percentile(0.5),
+            'latency_p99_s': percentile(0.99),
+            'latency_max_s': latencies[-1] if latencies else 0.0,
+        }
@@ -0,0 +1,56 @@
+import threading
+import zlib
+
+from common import LRUCache
+
+
+class RenderCache:
+    """
+    Rendered texts (or any other payloads) by key (spell index) for the newest corpus version, renders for an older
+    one (a handler started before a reload) are not cached. A payload is rendered once per version, texts longer
+    than COMPRESS_MIN bytes are kept zlib-compressed if compress is set.
+    """
+    COMPRESS_MIN = 256
+
+    def __init__(self, compress=False):
+        self.compress = compress
+        self.version = None
+        self.hits = self.misses = 0
+        self.__data = {}
+        self.__lock = threading.Lock()
+
+    def get(self, version, key, render) -> str:
+        """ render: function rendering the text on a miss """
+        with self.__lock:
+            if self.version is None or version > self.version:
+                self.__data = {}
+                self.version = version
+            data = self.__data.get(key) if version == self.version else None
+        if data is not None:
+            self.hits += 1
+            return zlib.decompress(data).decode() if isinstance(data, bytes) else data
+
+        self.misses += 1
+        text = render()
+        data = text
+        if self.compress and isinstance(text, str) and len(text) >= self.COMPRESS_MIN:
+            data = zlib.compress(text.encode())
+        with self.__lock:
+            if version == self.version:
+                self.__data[key] = data
+        return text
+
+    def stats(self) -> dict:
+        return {'size': len(self.__data), 'hits': self.hits, 'misses': self.misses}
+
+
+class KeyboardCache(LRUCache):
+    """ Inline keyboard rows of result sets, keyed by the corpus version and the spell indexes (names of homebrew
+    spells without one) of a result set """
+    def get_rows(self, version, spells, build) -> list:
+        key = (version, tuple(x.index or x.name for x in spells))
+        rows = self.get(key)
+        if rows is None:
+            rows = build()
+            self.put(key, rows)
+        return rows
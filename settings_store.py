@@ -0,0 +1,159 @@
+"""
+Persistent user and chat settings in SQLite, shared by restarts and by the worker processes.
+
+Reads go through an LRU cache, so the settings of active users are read from disk once. Writes land in the cache
+and in a write-behind buffer, flushed in one transaction every FLUSH_INTERVAL seconds or when FLUSH_SIZE entries
+are waiting. A crash loses at most the last FLUSH_INTERVAL seconds of changes. Every user is handled by one
+process (see Supervisor.worker_for), so the per-process caches never disagree.
+
+Search listings (the query behind a next page button, keyed by its fingerprint) are kept here too: they never change
+once written, so any process can answer a page button, after restarts as well. The expired ones are purged.
+"""
+import atexit
+import json
+import sqlite3
+import threading
+import time
+
+import metrics
+from common import LRUCache, createLogger
+
+logger = createLogger(__name__)
+
+USER, CHAT, LISTING = 'user', 'chat', 'listing'
+
+
+class SettingsStore:
+    db_path = '.settings.db'
+    CACHE_SIZE = 10000
+    FLUSH_INTERVAL = 1.0
+    FLUSH_SIZE = 1000
+    # id is a user or chat id, or a listing fingerprint
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS settings (kind TEXT NOT NULL, id NOT NULL, data TEXT NOT NULL, ' \
+             'PRIMARY KEY (kind, id)) WITHOUT ROWID'
+
+    def __init__(self, db_path=None, cache_size=CACHE_SIZE, flush_interval=FLUSH_INTERVAL, flush_size=FLUSH_SIZE):
+        self.db_path = db_path or self.db_path
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.reads = self.flushes = self.flushed = 0
+        self.flush_seconds = 0.0
+        self.__cache = LRUCache(cache_size)
+        self.__dirty = {}       # (kind, id) -> data waiting for the flush
+        self.__flushing = {}    # being written
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__stopped = threading.Event()
+        self.__local = threading.local()
+        self.__thread = None
+        self.__flush_seconds = metrics.registry.histogram('settings_flush_seconds', 'settings flush duration')
+        self.__flush_rows = metrics.registry.histogram('settings_flush_rows', 'settings written per flush',
+                                                       buckets=metrics.SIZE_BUCKETS)
+        with self.__connection() as conn:
+            conn.execute(self.SCHEMA)
+
+    def __connection(self) -> sqlite3.Connection:
+        """ One connection per thread, WAL lets the readers of all the processes go on during a flush """
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = self.__local.conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def start(self) -> 'SettingsStore':
+        self.__thread = threading.Thread(target=self.__flusher, name='settings-flush', daemon=True)
+        self.__thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        """ Flushes what is left """
+        self.__stopped.set()
+        self.__wake.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.flush()
+
+    def __flusher(self):
+        while not self.__stopped.is_set():
+            self.__wake.wait(self.flush_interval)
+            self.__wake.clear()
+            self.flush()
+
+    def get(self, kind, key) -> dict:
+        """ A copy of the settings, empty for unknown users and chats """
+        data = self.__cache.get((kind, key))
+        if data is None:
+            with self.__lock:
+                data = self.__dirty.get((kind, key), self.__flushing.get((kind, key)))
+            if data is None:
+                self.reads += 1
+                row = self.__connection().execute('SELECT data FROM settings WHERE kind = ? AND id = ?',
+                                                  (kind, key)).fetchone()
+                data = json.loads(row[0]) if row else {}
+            self.__cache.put((kind, key), data)
+        return dict(data)
+
+    def update(self, kind, key, values: dict) -> dict:
+        """ Sets the values (None removes a value), returns the new settings """
+        data = {k: v for k, v in {**self.get(kind, key), **values}.items() if v is not None}
+        self.__cache.put((kind, key), data)
+        with self.__lock:
+            self.__dirty[(kind, key)] = data
+            full = len(self.__dirty) >= self.flush_size
+        if full:
+            self.__wake.set()
+        return dict(data)
+
+    def pending(self) -> int:
+        return len(self.__dirty)
+
+    def flush(self):
+        """ Writes the buffered changes in one transaction, they are kept for the next flush on failure """
+        with self.__flush_lock:
+            with self.__lock:
+                dirty, self.__dirty = self.__dirty, {}
+                self.__flushing = dirty
+            if not dirty:
+                return
+            started = time.perf_counter()
+            try:
+                with self.__connection() as conn:
+                    conn.executemany('INSERT OR REPLACE INTO settings (kind, id, data) VALUES (?, ?, ?)',
+                                     [(kind, key, json.dumps(data)) for (kind, key), data in dirty.items()])
+            except sqlite3.Error as e:
+                logger.error(f'Can not save {len(dirty)} settings in {self.db_path}: {e}')
+                with self.__lock:
+                    # newer changes made during the flush win
+                    self.__dirty = {**dirty, **self.__dirty}
+                    self.__flushing = {}
+                return
+            with self.__lock:
+                self.__flushing = {}
+            took = time.perf_counter() - started
+            self.flushes += 1
+            self.flushed += len(dirty)
+            self.flush_seconds += took
+            self.__flush_seconds.observe(took)
+            self.__flush_rows.observe(len(dirty))
+
+    def purge(self, kind, field, before) -> int:
+        """ Removes the stored entries of the kind with data[field] less than before, returns their count """
+        self.flush()
+        try:
+            with self.__connection() as conn:
+                removed = conn.execute("DELETE FROM settings WHERE kind = ? AND json_extract(data, '$.' || ?) < ?",
+                                       (kind, field, before)).rowcount
+        except sqlite3.Error as e:
+            logger.error(f'Can not purge {kind} settings in {self.db_path}: {e}')
+            return 0
+        if removed:
+            logger.info(f'Purged {removed} {kind} settings')
+        return removed
+
+    def stats(self) -> dict:
+        return {**self.__cache.stats(), 'reads': self.reads, 'pending': self.pending(), 'flushes': self.flushes,
+                'flushed': self.flushed, 'flush_seconds': self.flush_seconds}
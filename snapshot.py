@@ -0,0 +1,203 @@
+"""
+Compiled spells snapshot: a binary file loaded with mmap, spells are decoded on first access.
+Processes opening the same snapshot share its pages through the OS page cache.
+
+Layout (little-endian):
+    header      MAGIC, format version, spells count, offsets of meta, columns, spell offsets and blobs
+    meta        JSON: {'columns': {field: {'values': [...], 'kind': 'scalar' | 'list',
+                                           'starts': offset, 'codes': offset, 'codes_count': n}}},
+                column offsets are relative to the columns start
+    columns     uint32 arrays: per field `starts` (count + 1) and `codes` into the field values, CSR style.
+                Values are normalized as Spell.normed does it
+    offsets     uint64 array (count + 1) of spell blob offsets relative to the blobs start
+    blobs       Spell.to_json() of every spell as utf-8 JSON
+
+The JSON cache stays the import/export format:
+
+    python snapshot.py [.cached-spells] [.cached-spells.snap]
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import Sequence
+
+from common import createLogger
+from dnd_spells import CacheCarier, DndSpellsError, Singleton, Spell, SpellIndex, Spells
+
+logger = createLogger(__name__)
+
+MAGIC = b'DNDSNAP\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIQQQQ')
+
+
+class SnapshotError(DndSpellsError):
+    pass
+
+
+def _check_byteorder():
+    if sys.byteorder != 'little':
+        raise SnapshotError('Snapshots are supported on little-endian hosts only')
+
+
+def _align(offset, n=8):
+    return offset + -offset % n
+
+
+def build(cached_spells: dict, snapshot_path):
+    """
+    Compiles the JSON cache contents ({'spells': [...]}) into a snapshot file
+    """
+    _check_byteorder()
+    spells = [Spells.create_spell(dict(x)) for x in cached_spells['spells']]
+
+    meta = {'columns': {}}
+    columns = bytearray()
+    for field in SpellIndex.FIELDS:
+        values, codes, starts = {}, array('I'), array('I', [0])
+        kind = 'scalar'
+        for spell in spells:
+            value = spell.normed(field)
+            if isinstance(value, frozenset):
+                kind = 'list'
+                value = sorted(value)
+            elif value is None or isinstance(value, dict):
+                value = []
+            else:
+                value = [value]
+            codes.extend(values.setdefault(x, len(values)) for x in value)
+            starts.append(len(codes))
+        meta['columns'][field] = {'values': list(values), 'kind': kind, 'starts': len(columns),
+                                  'codes': len(columns) + len(starts) * starts.itemsize, 'codes_count': len(codes)}
+        columns += starts.tobytes() + codes.tobytes()
+
+    blobs = [json.dumps(x.to_json()).encode() for x in spells]
+    offsets = array('Q', [0])
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+
+    meta = json.dumps(meta).encode()
+    meta_offset = HEADER.size
+    columns_offset = _align(meta_offset + len(meta))
+    offsets_offset = _align(columns_offset + len(columns))
+    blobs_offset = offsets_offset + len(offsets) * offsets.itemsize
+
+    tmp_path = f'{snapshot_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(spells), meta_offset, columns_offset, offsets_offset, blobs_offset))
+        f.write(meta)
+        f.write(bytes(columns_offset - f.tell()))
+        f.write(columns)
+        f.write(bytes(offsets_offset - f.tell()))
+        f.write(offsets.tobytes())
+        for blob in blobs:
+            f.write(blob)
+    # readers of the old snapshot keep their mapping, new ones open the new file
+    os.replace(tmp_path, snapshot_path)
+    logger.info(f'Built snapshot {snapshot_path}: {len(spells)} spells')
+
+
+class Column(Sequence):
+    """ Normalized values of a field for every spell: str (or None) for scalar fields, frozenset for lists """
+    def __init__(self, buf, columns_offset, count, column: dict):
+        self.values = column['values']
+        self.is_list = column['kind'] == 'list'
+        starts = columns_offset + column['starts']
+        codes = columns_offset + column['codes']
+        self.starts = buf[starts:starts + (count + 1) * 4].cast('I')
+        self.codes = buf[codes:codes + column['codes_count'] * 4].cast('I')
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, i):
+        values = [self.values[x] for x in self.codes[self.starts[i]:self.starts[i + 1]]]
+        if self.is_list:
+            return frozenset(values)
+        return values[0] if values else None
+
+
+class SpellSnapshot(Sequence):
+    """
+    Read-only sequence of Spell objects backed by a mmapped snapshot file, a spell is decoded on first access
+    """
+    def __init__(self, snapshot_path):
+        _check_byteorder()
+        with open(snapshot_path, 'rb') as f:
+            self.__mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__buf = memoryview(self.__mmap)
+        magic, version, self.count, meta_offset, columns_offset, offsets_offset, self.__blobs_offset = \
+            HEADER.unpack_from(self.__buf)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise SnapshotError(f'{snapshot_path} is not a spells snapshot of version {FORMAT_VERSION}')
+        meta = json.loads(bytes(self.__buf[meta_offset:columns_offset]).rstrip(b'\0'))
+        self.columns = {field: Column(self.__buf, columns_offset, self.count, x)
+                        for field, x in meta['columns'].items()}
+        self.__offsets = self.__buf[offsets_offset:offsets_offset + (self.count + 1) * 8].cast('Q')
+        self.__decoded = [None] * self.count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[x] for x in range(*i.indices(self.count))]
+        spell = self.__decoded[i]
+        if spell is None:
+            start = self.__blobs_offset + self.__offsets[i]
+            end = self.__blobs_offset + self.__offsets[i + 1]
+            spell = self.__decoded[i] = Spell(**json.loads(bytes(self.__buf[start:end])))
+        return spell
+
+    def decoded_count(self) -> int:
+        return sum(x is not None for x in self.__decoded)
+
+
+class SnapshotCarier(Singleton):
+    """
+    CacheCarier reading spells from a compiled snapshot. The snapshot is (re)built from the JSON cache
+    whenever the JSON cache is newer, cache() writes both.
+    """
+    snapshot_path = '.cached-spells.snap'
+    json_carier = CacheCarier()
+
+    @classmethod
+    def get_spells(cls) -> dict:
+        logger.info('Getting data from snapshot')
+        json_path = cls.json_carier.cache_path
+        try:
+            if not os.path.exists(cls.snapshot_path) or (
+                    os.path.exists(json_path) and os.path.getmtime(json_path) > os.path.getmtime(cls.snapshot_path)):
+                cached_spells = cls.json_carier.get_spells()
+                if not cached_spells or not cached_spells.get('spells'):
+                    return {}
+                build(cached_spells, cls.snapshot_path)
+            snapshot = SpellSnapshot(cls.snapshot_path)
+        except (IOError, ValueError, SnapshotError) as e:
+            logger.warning(f'Can not get data from {cls.snapshot_path}: {e}')
+            return cls.json_carier.get_spells()
+        logger.info('Got snapshot data')
+        return {'spells': snapshot, 'columns': snapshot.columns}
+
+    @classmethod
+    def raw(cls) -> dict:
+        """ The JSON cache the snapshot is built from, get_spells() returns Spell objects without the versions """
+        return cls.json_carier.raw()
+
+    @classmethod
+    def cache(cls, spells: dict):
+        cls.json_carier.cache(spells)
+        try:
+            build(spells, cls.snapshot_path)
+        except (IOError, SnapshotError) as e:
+            logger.warning(f'Can not save snapshot in {cls.snapshot_path}: {e}')
+
+
+if __name__ == '__main__':
+    json_path = sys.argv[1] if len(sys.argv) > 1 else CacheCarier.cache_path
+    snapshot_path = sys.argv[2] if len(sys.argv) > 2 else SnapshotCarier.snapshot_path
+    with open(json_path, 'r') as f:
+        build(json.load(f), snapshot_path)
@@ -0,0 +1,46 @@
+"""
+Startup phases of the bot, timed from the import of this module (the first import of bot.py): module imports,
+corpus loading and warm-up. The corpus is loaded in background behind the readiness gate of SpellsReference
+(see hot_reload.py), so the commands not needing spells (/help) are answered at once.
+
+    python bot.py --profile-startup
+"""
+import contextlib
+import threading
+import time
+
+started = time.perf_counter()
+
+
+class Phases:
+    """ Named phases with their start offsets and durations, recorded from any thread """
+    def __init__(self):
+        self.records = []   # (name, start, duration, thread name)
+        self.__lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.__lock:
+                self.records.append((name, start - started, end - start, threading.current_thread().name))
+
+    def mark(self, name):
+        """ A moment rather than a phase, e.g. 'ready for commands' """
+        with self.__lock:
+            self.records.append((name, time.perf_counter() - started, 0.0, threading.current_thread().name))
+
+    def report(self) -> str:
+        with self.__lock:
+            records = sorted(self.records, key=lambda x: x[1])
+        width = max([len(x[0]) for x in records] + [5])
+        lines = [f'{"phase":<{width}}  {"start ms":>9}  {"took ms":>9}  thread']
+        for name, start, duration, thread in records:
+            lines.append(f'{name:<{width}}  {start * 1000:9.1f}  {duration * 1000:9.1f}  {thread}')
+        return '\n'.join(lines)
+
+
+phases = Phases()
@@ -0,0 +1,188 @@
+"""
+Webhook mode: an asyncio HTTP server taking Telegram updates (POST, JSON body) and handing them to a dispatcher.
+
+Handlers are synchronous, they run in a thread pool so spell lookups never block the event loop. Updates of a chat
+are handled one at a time in the order they came, updates of different chats concurrently. At most MAX_IN_FLIGHT
+updates are handled at once, the rest wait for a slot up to SLOT_TIMEOUT and are refused with 503 after that,
+so Telegram delivers them again later. The response is sent when the update has been handled.
+
+    WEBHOOK_URL=https://example.com/<path> WEBHOOK_PORT=8443 python bot.py
+"""
+import asyncio
+import contextlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+
+from common import createLogger
+
+logger = createLogger(__name__)
+
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+
+class WebhookServer:
+    MAX_IN_FLIGHT = 64
+    THREADS = 16
+    SLOT_TIMEOUT = 5.0
+    MAX_BODY = 1 << 20
+    SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+    def __init__(self, dispatcher, host='127.0.0.1', port=8443, path='/', secret=None,
+                 max_in_flight=MAX_IN_FLIGHT, threads=THREADS):
+        """
+        dispatcher: telegram.ext.Dispatcher with the handlers, its process_update is called for every update
+        secret: the secret_token given to setWebhook, requests without it are refused
+        """
+        self.dispatcher = dispatcher
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.max_in_flight = max_in_flight
+        self.threads = threads
+        self.handled = self.refused = self.failed = 0
+        self.__chats = {}   # chat_id -> [lock, users]
+        self.__slots = None
+        self.__executor = None
+        self.__server = None
+        self.__connections = {}     # writer -> task serving the connection
+
+    async def start(self) -> 'WebhookServer':
+        self.__slots = asyncio.Semaphore(self.max_in_flight)
+        self.__executor = ThreadPoolExecutor(self.threads, thread_name_prefix='webhook')
+        self.__server = await asyncio.start_server(self.__serve, self.host, self.port)
+        self.port = self.__server.sockets[0].getsockname()[1]
+        logger.info(f'Webhook server at http://{self.host}:{self.port}{self.path}')
+        return self
+
+    async def stop(self):
+        self.__server.close()
+        tasks = list(self.__connections.values())
+        for writer in list(self.__connections):
+            writer.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.__server.wait_closed()
+        self.__executor.shutdown(wait=True)
+
+    def run(self):
+        """ Serves until interrupted """
+        async def serve():
+            await self.start()
+            async with self.__server:
+                await self.__server.serve_forever()
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.__executor:
+                self.__executor.shutdown(wait=True)
+
+    def in_flight(self) -> int:
+        return self.max_in_flight - self.__slots._value if self.__slots else 0
+
+    async def __serve(self, reader, writer):
+        """ One connection, HTTP/1.1 keep-alive """
+        self.__connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = (request_line.decode('latin-1').split() + ['', '', ''])[:3]
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = headers.get('content-length') or '0'
+                if not length.isdigit():
+                    # the body can not be told from the next request
+                    await self.__respond(writer, 400, close=True)
+                    break
+                length = int(length)
+                if length > self.MAX_BODY:
+                    await self.__respond(writer, 413, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                status = await self.__handle(method, target, headers, body)
+                close = headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0'
+                await self.__respond(writer, status, close)
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.__connections.pop(writer, None)
+            writer.close()
+
+    async def __respond(self, writer, status, close=False):
+        writer.write(f'HTTP/1.1 {status} {REASONS[status]}\r\nContent-Length: 0\r\n'
+                     f'Connection: {"close" if close else "keep-alive"}\r\n\r\n'.encode())
+        await writer.drain()
+
+    async def __handle(self, method, target, headers, body) -> int:
+        if target.split('?')[0] != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+        if self.secret is not None and headers.get(self.SECRET_HEADER) != self.secret:
+            return 403
+        try:
+            data = json.loads(body)
+        except ValueError as e:
+            logger.warning(f'Wrong update: {e}')
+            return 400
+        if not isinstance(data, dict) or type(data.get('update_id')) is not int:
+            logger.warning('Wrong update: not an object with an integer update_id')
+            return 400
+        try:
+            update = Update.de_json(data, self.dispatcher.bot)
+        except Exception as e:
+            logger.warning(f'Wrong update: {e}')
+            return 400
+        if not isinstance(update, Update):
+            return 400
+
+        try:
+            await asyncio.wait_for(self.__slots.acquire(), self.SLOT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.refused += 1
+            return 503
+        try:
+            chat = update.effective_chat
+            async with self.__chat_lock(chat.id if chat else None):
+                await asyncio.get_running_loop().run_in_executor(self.__executor, self.__process, update)
+        finally:
+            self.__slots.release()
+        return 200
+
+    def __process(self, update):
+        try:
+            self.dispatcher.process_update(update)
+            self.handled += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f'Update {update.update_id} failed: {e}')
+
+    @contextlib.asynccontextmanager
+    async def __chat_lock(self, chat_id):
+        """ Updates of a chat are handled in order """
+        if chat_id is None:
+            yield
+            return
+        entry = self.__chats.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.__chats[chat_id]
+
+    def stats(self) -> dict:
+        return {'in_flight': self.in_flight(), 'chats': len(self.__chats), 'handled': self.handled,
+                'refused': self.refused, 'failed': self.failed}
@@ -0,0 +1,144 @@
+"""
+Multi-process mode: the polling process (the supervisor) fans the updates out to worker processes.
+The corpus is published as a snapshot (see snapshot.py). Workers mmap it read-only, so all of them share one copy
+of the spells and of the index columns through the OS page cache, and a worker starts without loading the corpus.
+
+    WORKERS=4 python bot.py
+
+A new corpus version (a newer JSON cache) is published automatically, or on SIGHUP, and every worker swaps it in
+without stopping (see hot_reload.py).
+"""
+import json
+import multiprocessing
+import os
+import signal
+import threading
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from common import createLogger
+from dnd_spells import CacheCarier
+from snapshot import SnapshotCarier
+
+logger = createLogger(__name__)
+
+
+def work(number, count, queue):
+    """ Worker process: handles the updates of its queue with the bot handlers """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ['SPELL_STORE'] = 'snapshot'
+    import bot
+    from telegram import Bot
+    from telegram.ext import Dispatcher
+    from hot_reload import Refresher
+    from outbox import Outbox
+    from settings_store import SettingsStore
+
+    # the workers share Telegram limits
+    bot.outbox = Outbox(global_rate=Outbox.GLOBAL_RATE / count,
+                        global_burst=max(1, Outbox.GLOBAL_BURST // count)).start()
+    if bot.METRICS_PORT is not None:
+        bot.METRICS_PORT += 1 + number
+    bot.user_settings = SettingsStore(bot.SETTINGS_DB).start()
+    bot.register_metrics()
+    telegram_bot = Bot(token=bot.TOKEN)
+    dispatcher = Dispatcher(telegram_bot, None, workers=1, use_context=True)
+    bot.add_handlers(dispatcher)
+    # the snapshot spells are decoded on use, a warm up would give every worker its own copy of them all
+    refresher = Refresher(bot.spells, bot.load_spells, warm=False)
+    # the snapshot is mapped in background, updates coming meanwhile are answered with 'still loading'
+    bot.spells.start_loading()
+    logger.info(f'Worker {number} is ready')
+
+    while (message := queue.get()) is not None:
+        kind, data = message
+        if kind == 'update':
+            dispatcher.process_update(Update.de_json(json.loads(data), telegram_bot))
+        elif kind == 'reload':
+            # built off the update loop and swapped in, updates are handled with the old corpus meanwhile
+            threading.Thread(target=refresher.refresh, name='reload', daemon=True).start()
+    bot.user_settings.stop()
+    bot.outbox.stop()
+
+
+class Supervisor:
+    """
+    Starts the workers and forwards them the updates. Updates of a user always go to the same worker,
+    so user_data and the cached user settings stay consistent. A worker that died is restarted.
+    """
+    CHECK_INTERVAL = 1.0
+    STOP_TIMEOUT = 10
+
+    def __init__(self, workers=4):
+        self.count = workers
+        self.__context = multiprocessing.get_context('spawn')
+        self.__queues = [self.__context.Queue() for _ in range(workers)]
+        self.__processes = [None] * workers
+        self.__published = None
+        self.__stopped = threading.Event()
+
+    def attach(self, dispatcher) -> 'Supervisor':
+        """ Starts the workers and forwards them every update of the dispatcher. Call from the main thread """
+        self.start()
+        dispatcher.add_handler(TypeHandler(Update, self.forward))
+        signal.signal(signal.SIGHUP, lambda *_: self.publish())
+        return self
+
+    def start(self) -> 'Supervisor':
+        self.publish(notify=False)
+        for number in range(self.count):
+            self.__start_worker(number)
+        threading.Thread(target=self.__watch, name='supervisor', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.__stopped.set()
+        for queue in self.__queues:
+            queue.put(None)
+        for process in self.__processes:
+            process.join(self.STOP_TIMEOUT)
+
+    def __start_worker(self, number):
+        process = self.__context.Process(target=work, args=(number, self.count, self.__queues[number]),
+                                         name=f'worker-{number}', daemon=True)
+        process.start()
+        self.__processes[number] = process
+
+    def __watch(self):
+        while not self.__stopped.wait(self.CHECK_INTERVAL):
+            for number, process in enumerate(self.__processes):
+                if not process.is_alive() and not self.__stopped.is_set():
+                    logger.warning(f'Worker {number} exited with {process.exitcode}, restarting')
+                    # a killed worker may hold the queue lock, its queued updates are dropped
+                    self.__queues[number] = self.__context.Queue()
+                    self.__start_worker(number)
+            if self.__cache_version() != self.__published:
+                self.publish()
+
+    @staticmethod
+    def __cache_version():
+        try:
+            return os.path.getmtime(CacheCarier.cache_path)
+        except OSError:
+            return None
+
+    def publish(self, notify=True):
+        """
+        Rebuilds the snapshot if the JSON cache is newer and makes the workers reopen it.
+        The snapshot file is replaced atomically, workers keep the old mapping until they reload
+        """
+        self.__published = self.__cache_version()
+        SnapshotCarier.get_spells()
+        if notify:
+            logger.info('Publishing a new spells version')
+            for queue in self.__queues:
+                queue.put(('reload', None))
+
+    def worker_for(self, update: Update) -> int:
+        user, chat = update.effective_user, update.effective_chat
+        key = user.id if user else chat.id if chat else update.update_id
+        return key % self.count
+
+    def forward(self, update: Update, context):
+        self.__queues[self.worker_for(update)].put(('update', update.to_json()))